@@ -0,0 +1,531 @@
+# cython: language_level=3
+import collections
+import functools
+import hashlib
+import io
+import os
+import sqlite3
+import stat
+import struct
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from pathlib import Path
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+__all__ = ['Sink', 'ZipWriter', 'StoredZip', 'CrcCache', 'walk', 'fingerprint', 'compressible', 'deflate', 'write_zip', 'write_tar', 'write_archive', 'ArchiveCache', 'FORMATS']
+
+FORMATS = ['zip', 'tar', 'tar.zst']
+
+# 本身已经压缩过的格式, 打包时直接存储
+STORED = {
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.br', '.apk', '.jar', '.ipa', '.whl',
+    '.mp4', '.mkv', '.mov', '.avi', '.flv', '.webm', '.m4v', '.rmvb', '.rm', '.wmv', '.ts',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac', '.ape', '.amr',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.docx', '.xlsx', '.pptx', '.epub', '.azw3', '.woff', '.woff2',
+}
+
+# compress参数对应的deflate/zstd压缩级别
+ZIP_LEVELS = {'fast': 1, 'best': 9}
+ZST_LEVELS = {'none': -5, 'fast': 1, 'best': 19}
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = (1 << 31) - 1
+BLOCK_SIZE = 1 << 20
+
+
+class Sink(io.RawIOBase):
+    '''不可seek的输出, 攒够chunk_size后交给write回调, 回调阻塞到客户端收下为止, 内存占用与压缩包大小无关
+    '''
+
+    def __init__(self, write, chunk_size=1 << 20):
+        self.callback = write
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if self.buffer:
+            data, self.buffer = bytes(self.buffer), bytearray()
+            self.callback(data)
+
+
+def walk(root):
+    '''按路径排序返回root下的全部文件(path, 包内路径), 与目录列表一致跳过隐藏文件, 不跟随目录软链接
+    '''
+    for top, dirs, files in os.walk(root):
+        dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+        for name in sorted(x for x in files if not x.startswith('.')):
+            path = os.path.join(top, name)
+            yield path, os.path.join(root.name, os.path.relpath(path, root))
+
+
+def fingerprint(root):
+    '''root下将被打包的全部文件的(包内路径, 大小, mtime)摘要, 每个文件stat一次, 不读取内容
+    文件原地修改不会改变目录mtime, 所以不能只依赖目录列表缓存
+    '''
+    digest = hashlib.sha1()
+    for path, arcname in walk(root):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            digest.update(f'{arcname}\0{st.st_size}\0{st.st_mtime_ns}\0'.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def compressible(path, size, sample=1 << 16):
+    '''按扩展名判断, 未知格式的大文件再从中间取样试压一次
+    '''
+    if os.path.splitext(path)[1].lower() in STORED:
+        return False
+    if size < sample * 2:
+        return True
+    try:
+        with open(path, 'rb') as fp:
+            fp.seek(size // 2)
+            data = fp.read(sample)
+    except OSError:
+        return True
+    return len(zlib.compress(data, 1)) < len(data) * 0.9
+
+
+class Member:
+    '''zip中的一个成员, 记录生成本地文件头/data descriptor/中央目录所需的全部字段
+    '''
+    __slots__ = ('name', 'flags', 'method', 'dostime', 'dosdate', 'crc', 'csize', 'size', 'offset', 'attr', 'zip64')
+
+    def __init__(self, arcname, mtime, mode, method, zip64, offset):
+        self.name = arcname.encode('utf-8', 'surrogateescape')
+        self.flags = 0x08 | (0x800 if not arcname.isascii() else 0)
+        self.method = method
+        self.dostime, self.dosdate = dostime(mtime)
+        self.crc = self.csize = self.size = 0
+        self.offset = offset
+        self.attr = (mode & 0xFFFF) << 16
+        self.zip64 = zip64
+
+    def local_header(self):
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if self.zip64 else b''
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if self.zip64 else 20, self.flags, self.method,
+                           self.dostime, self.dosdate, 0, 0xFFFFFFFF if self.zip64 else 0,
+                           0xFFFFFFFF if self.zip64 else 0, len(self.name), len(extra)) + self.name + extra
+
+    def descriptor(self):
+        if not self.zip64 and max(self.csize, self.size) > ZIP64_LIMIT:
+            raise RuntimeError(f'{self.name.decode()} grew past the zip64 limit while archiving')
+        return struct.pack('<IIQQ' if self.zip64 else '<IIII', 0x08074b50, self.crc, self.csize, self.size)
+
+    def central_header(self):
+        extra = [x for x in (self.size, self.csize, self.offset) if x > ZIP64_LIMIT]
+        extra = struct.pack(f'<HH{len(extra)}Q', 1, 8 * len(extra), *extra) if extra else b''
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 45 if extra else 20, 45 if self.zip64 or extra else 20,
+                           self.flags, self.method, self.dostime, self.dosdate, self.crc,
+                           0xFFFFFFFF if self.csize > ZIP64_LIMIT else self.csize,
+                           0xFFFFFFFF if self.size > ZIP64_LIMIT else self.size,
+                           len(self.name), len(extra), 0, 0, 0, self.attr,
+                           0xFFFFFFFF if self.offset > ZIP64_LIMIT else self.offset) + self.name + extra
+
+
+def dostime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def end_records(count, start, length):
+    '''中央目录之后的结尾记录, 条目数或偏移超过限制时加上zip64结尾记录和定位符
+    '''
+    data = b''
+    if count >= 0xFFFF or length > ZIP64_LIMIT or start > ZIP64_LIMIT:
+        data += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, length, start)
+        data += struct.pack('<IIQI', 0x07064b50, 0, start + length, 1)
+    return data + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                              min(length, 0xFFFFFFFF), min(start, 0xFFFFFFFF), 0)
+
+
+class ZipWriter:
+    '''只追加的zip写入器: 本地文件头 + 数据 + data descriptor, close时写中央目录
+    数据由调用方压缩好后按块写入, 大小或偏移超过限制时自动使用zip64
+    '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.entries = []
+        self.current = None
+
+    def emit(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def begin(self, arcname, mtime, size, mode, method):
+        self.current = Member(arcname, mtime, mode, method, size * 1.05 > ZIP64_LIMIT, self.offset)
+        self.emit(self.current.local_header())
+
+    def write(self, raw, data):
+        self.current.crc = zlib.crc32(raw, self.current.crc)
+        self.current.csize += len(data)
+        self.current.size += len(raw)
+        self.emit(data)
+
+    def end(self):
+        self.emit(self.current.descriptor())
+        self.entries.append(self.current)
+        self.current = None
+
+    def close(self):
+        start = self.offset
+        for member in self.entries:
+            self.emit(member.central_header())
+        self.emit(end_records(len(self.entries), start, self.offset - start))
+
+
+class CrcCache:
+    '''文件CRC32的缓存, 按路径保存大小/mtime/CRC到SQLite, 多个worker共享
+    下载过程中读完的文件都会记下CRC, 断点续传到中央目录时不必重读整个目录
+    '''
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            conn = self.local.conn = sqlite3.connect(self.filename, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS crc (path BLOB PRIMARY KEY, size INTEGER, mtime INTEGER, crc INTEGER)')
+        return conn
+
+    def get(self, path, size, mtime_ns):
+        try:
+            row = self.conn.execute('SELECT size, mtime, crc FROM crc WHERE path = ?', (os.fsencode(path),)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[2] if row and row[:2] == (size, mtime_ns) else None
+
+    def put(self, path, size, mtime_ns, crc):
+        try:
+            with self.conn as conn:
+                conn.execute('INSERT OR REPLACE INTO crc VALUES (?, ?, ?, ?)', (os.fsencode(path), size, mtime_ns, crc))
+        except sqlite3.Error:
+            pass
+
+
+class StoredZip:
+    '''不压缩的zip, 只凭文件列表就能算出每个成员的偏移和总长度, 因此可以按任意Range生成, 且输出确定
+    data descriptor和中央目录中的CRC在需要时才计算, 有crcs(CrcCache)时按(path, size, mtime)共享
+    '''
+
+    def __init__(self, root, crcs=None):
+        self.crcs = crcs
+        self.members = []
+        self.paths = []
+        self.known = set()
+        etag = hashlib.sha1()
+        offset = 0
+        for path, arcname in walk(root):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            member = Member(arcname, st.st_mtime, st.st_mode, ZIP_STORED, st.st_size > ZIP64_LIMIT, offset)
+            member.csize = member.size = st.st_size
+            self.members.append(member)
+            self.paths.append((path, st.st_mtime_ns))
+            offset += len(member.local_header()) + member.size + (24 if member.zip64 else 16)
+            etag.update(f'{arcname}\0{st.st_size}\0{st.st_mtime_ns}\0'.encode('utf-8', 'surrogateescape'))
+        self.start = offset
+        # 中央目录的长度与CRC无关, 可以先用占位的CRC算出
+        self.length = sum(len(m.central_header()) for m in self.members)
+        self.size = self.start + self.length + len(end_records(len(self.members), self.start, self.length))
+        self.etag = f'"{etag.hexdigest()}"'
+
+    def crc(self, i):
+        '''第i个文件的CRC, 本对象和crcs中都没有时读一遍文件'''
+        if i not in self.known:
+            path, mtime_ns = self.paths[i]
+            value = self.crcs.get(path, self.members[i].size, mtime_ns) if self.crcs else None
+            if value is None:
+                value = 0
+                with open(path, 'rb') as fp:
+                    for data in iter(functools.partial(fp.read, BLOCK_SIZE), b''):
+                        value = zlib.crc32(data, value)
+                self.remember(i, value)
+            else:
+                self.members[i].crc = value
+                self.known.add(i)
+        return self.members[i].crc
+
+    def remember(self, i, value):
+        self.members[i].crc = value
+        self.known.add(i)
+        if self.crcs:
+            self.crcs.put(self.paths[i][0], self.members[i].size, self.paths[i][1], value)
+
+    def segments(self):
+        '''按顺序返回(偏移, 长度, 生成函数), 生成函数接收段内的起止位置'''
+        for i, member in enumerate(self.members):
+            header = member.local_header()
+            yield member.offset, len(header), lambda a, b, x=header: x[a:b]
+            yield member.offset + len(header), member.size, functools.partial(self.data, i)
+            yield (member.offset + len(header) + member.size, 24 if member.zip64 else 16,
+                   lambda a, b, i=i: (self.crc(i), self.members[i].descriptor())[1][a:b])
+        offset = self.start
+        for i, member in enumerate(self.members):
+            header_len = len(member.central_header())
+            yield offset, header_len, lambda a, b, i=i: (self.crc(i), self.members[i].central_header())[1][a:b]
+            offset += header_len
+        end = end_records(len(self.members), self.start, self.length)
+        yield offset, len(end), lambda a, b: end[a:b]
+
+    def data(self, i, start, end):
+        '''读取第i个文件[start, end)的内容, 从头读完整个文件时顺便记下CRC'''
+        size = self.members[i].size
+        value = 0
+        with open(self.paths[i][0], 'rb') as fp:
+            fp.seek(start)
+            position = start
+            while position < end:
+                data = fp.read(min(BLOCK_SIZE, end - position))
+                if not data:
+                    raise RuntimeError(f'{self.paths[i][0]} changed while archiving')
+                if start == 0:
+                    value = zlib.crc32(data, value)
+                position += len(data)
+                yield data
+        if start == 0 and end == size and i not in self.known:
+            self.remember(i, value)
+
+    def read(self, start, end, write):
+        '''按顺序把[start, end)的内容交给write'''
+        for offset, length, func in self.segments():
+            if offset + length <= start or length == 0:
+                continue
+            if offset >= end:
+                break
+            a, b = max(start - offset, 0), min(end - offset, length)
+            data = func(a, b)
+            if isinstance(data, bytes):
+                write(data)
+            else:
+                for chunk in data:
+                    write(chunk)
+
+
+def deflate(data, level, zdict, last):
+    '''独立压缩一个块, 以前一块末尾32K作为字典, 非末块用Z_SYNC_FLUSH对齐, 各块输出直接拼接即为完整的deflate流
+    '''
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def write_zip(root, write, compress=None, executor=None, workers=0, chunk_size=1 << 20):
+    '''把root目录流式打包为zip, 超过4G的文件和总大小自动使用zip64
+    compress: none全部存储, fast/best为deflate级别1/9, 默认级别6, 已压缩的文件始终直接存储
+    有executor时按1M分块并行压缩, 最多同时压缩2倍workers个块, 完成的块按顺序写出
+    '''
+    sink = Sink(write, chunk_size)
+    zw = ZipWriter(sink)
+    level = ZIP_LEVELS.get(compress, 6)
+    window = max(workers, 1) * 2 if executor else 0
+    steps = collections.deque()
+
+    def push(step, *args):
+        steps.append(functools.partial(step, *args))
+        while len(steps) > window:
+            steps.popleft()()
+
+    def done(raw, future):
+        zw.write(raw, future.result())
+
+    for path, arcname in walk(root):
+        try:
+            src = open(path, 'rb')
+            st = os.fstat(src.fileno())
+        except OSError:
+            continue
+        with src:
+            deflated = compress != 'none' and compressible(path, st.st_size)
+            push(zw.begin, arcname, st.st_mtime, st.st_size, stat.S_IMODE(st.st_mode) | stat.S_IFREG,
+                 ZIP_DEFLATED if deflated else ZIP_STORED)
+            data, prev = src.read(BLOCK_SIZE), b''
+            while True:
+                after = src.read(BLOCK_SIZE) if data else b''
+                if deflated:
+                    if executor:
+                        future = executor.submit(deflate, data, level, prev[-32768:], not after)
+                    else:
+                        future = Future()
+                        future.set_result(deflate(data, level, prev[-32768:], not after))
+                    push(done, data, future)
+                else:
+                    push(zw.write, data, data)
+                if not after:
+                    break
+                data, prev = after, data
+            push(zw.end)
+    while steps:
+        steps.popleft()()
+    zw.close()
+    sink.flush()
+
+
+def write_tar(root, write, compress=None, zst=False, threads=0, chunk_size=1 << 20):
+    '''把root目录流式打包为tar, zst为True时整体用zstd压缩(需要安装zstandard), threads为zstd的压缩线程数
+    '''
+    sink = Sink(write, chunk_size)
+    if zst:
+        cctx = zstandard.ZstdCompressor(level=ZST_LEVELS.get(compress, 3), threads=threads)
+        fileobj = cctx.stream_writer(sink, closefd=False)
+    else:
+        fileobj = sink
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as tf:
+        for path, arcname in walk(root):
+            try:
+                tarinfo = tf.gettarinfo(path, arcname)
+                src = open(path, 'rb')
+            except OSError:
+                continue
+            with src:
+                tf.addfile(tarinfo, src)
+    if zst:
+        fileobj.close()
+    sink.flush()
+
+
+def write_archive(root, write, format='zip', compress=None, executor=None, workers=0):
+    if format == 'tar':
+        return write_tar(root, write, compress)
+    if format == 'tar.zst':
+        return write_tar(root, write, compress, zst=True, threads=workers)
+    return write_zip(root, write, compress, executor, workers)
+
+
+class ArchiveCache:
+    '''打包好的压缩包缓存在磁盘上, key包含目录内容指纹(见fingerprint), 内容变化后自然失效
+    按mtime做LRU, 命中时更新mtime, 总大小超过max_bytes时删除最久未用的
+    多个worker共享同一目录, 同一key同时只有一个请求在生成, key以压缩包扩展名结尾
+    '''
+
+    def __init__(self, directory, max_bytes, expire=86400):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.expire = expire
+        self.locks = {}
+
+    def path(self, key):
+        return self.directory / f'{hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()}{os.path.splitext(key)[1]}'
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def claim(self, key, expire=600):
+        '''返回用于生成key的临时文件, 已有其他请求在生成时返回None
+        以O_EXCL创建的.lock文件标记正在生成, 超过expire秒的锁视为遗留; 每个请求的临时文件名都不同,
+        因此即使锁被当作遗留抢走, 两个请求也不会写同一个文件, 提交或放弃时只删除自己的锁
+        '''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        lock = path.with_suffix('.lock')
+        try:
+            if time.time() - os.stat(lock).st_mtime > expire:
+                lock.unlink()
+        except OSError:
+            pass
+        token = os.urandom(6).hex()
+        try:
+            with open(lock, 'x') as f:
+                f.write(token)
+        except OSError:
+            return None
+        fp = open(path.with_suffix(f'.{token}.tmp'), 'xb')
+        self.locks[fp.name] = (lock, token)
+        return fp
+
+    def release(self, fp):
+        lock, token = self.locks.pop(fp.name, (None, None))
+        try:
+            if lock and lock.read_text() == token:
+                lock.unlink()
+        except OSError:
+            pass
+
+    def commit(self, key, fp):
+        fp.close()
+        try:
+            os.replace(fp.name, self.path(key))
+        finally:
+            self.release(fp)
+        self.evict()
+
+    def abort(self, fp):
+        fp.close()
+        try:
+            os.unlink(fp.name)
+        except OSError:
+            pass
+        self.release(fp)
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(('.tmp', '.lock')):
+                # 生成过程中进程退出留下的文件
+                if time.time() - st.st_mtime > self.expire:
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+            else:
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(x[1] for x in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
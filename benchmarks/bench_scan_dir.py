@@ -0,0 +1,82 @@
+# cython: language_level=3
+'''scan_dir 吞吐测试
+
+    python benchmarks/bench_scan_dir.py [--files 100000] [--repeat 3]
+
+对比旧的 pathlib 实现 (exists + stat * 2 + is_dir + relative_to) 与基于 os.scandir 的实现,
+输出每秒处理的条目数
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from listing import ListingCache, scan  # noqa: E402
+from utils import Dict  # noqa: E402
+
+
+def legacy_scan_dir(base, root):
+    entries = []
+    for item in root.iterdir():
+        if not item.exists():
+            continue
+        if item.name.startswith('.'):
+            continue
+        path = item.relative_to(base)
+        entries.append(Dict({
+            'path': path,
+            'mtime': int(item.stat().st_mtime),
+            'size': item.stat().st_size,
+            'is_dir': item.is_dir(),
+            'num': 0
+        }))
+    entries.sort(key=lambda x: str(x.path).lower())
+    return entries
+
+
+def scandir_scan_dir(base, root):
+    '''Application.scan_dir未命中缓存时的路径: stat + listing.scan + 写入ListingCache
+    '''
+    cache = ListingCache()
+    st_mtime = os.stat(root).st_mtime
+    entries = cache.get(root, st_mtime)
+    if entries is None:
+        entries = scan(base, root, st_mtime)
+        cache[root] = entries
+    return entries
+
+
+def bench(func, base, root, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(func(base, root))
+        best = min(best, time.perf_counter() - start)
+    return count, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp)
+        root = base / 'bench'
+        root.mkdir()
+        for i in range(args.files):
+            fd = os.open(root / f'file_{i:07d}.txt', os.O_CREAT | os.O_WRONLY)
+            os.close(fd)
+
+        for name, func in [('pathlib', legacy_scan_dir), ('scandir', scandir_scan_dir)]:
+            count, cost = bench(func, base, root, args.repeat)
+            print(f'{name:8s} entries: {count} cost: {cost:.3f}s rate: {count / cost:,.0f} entries/sec')
+
+
+if __name__ == '__main__':
+    main()
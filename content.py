@@ -0,0 +1,192 @@
+# cython: language_level=3
+import collections
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import tornado.escape
+
+__all__ = ['ContentIndex']
+
+SUFFIXES = {
+    'md', 'markdown', 'txt', 'log', 'py', 'sh', 'cu', 'h', 'hpp', 'c', 'cpp', 'vue', 'php', 'js', 'ts', 'tsx',
+    'css', 'html', 'less', 'scss', 'pig', 'java', 'go', 'ini', 'conf', 'toml', 'vim', 'lrc', 'm3u', 'cfg',
+    'lua', 'rb', 'yml', 'yaml', 'json', 'xml', 'repo', 'csv', 'sql', 'rs', 'kt', 'swift', 'rst', 'tex',
+}
+
+
+class ContentIndex:
+    '''文本/代码文件的全文索引, 基于SQLite FTS5的trigram分词, 支持中文和任意子串
+    只在indexer中由后台线程按目录增量写入, 各worker以只读连接查询
+    '''
+
+    def __init__(self, filename, max_size=1 << 20, workers=4):
+        self.filename = Path(filename)
+        self.max_size = max_size
+        self.workers = workers
+        self.local = threading.local()
+        self.queue = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.pruning = False
+        self.thread = None
+        self.logger = logging.getLogger()
+
+    def connect(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.filename)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, dir TEXT, name TEXT, mtime INTEGER, size INTEGER, UNIQUE (dir, name))')
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS content USING fts5(body, tokenize='trigram')")
+        return conn
+
+    @property
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True)
+        return conn
+
+    def accept(self, name, size):
+        return 0 < size <= self.max_size and os.path.splitext(name)[1][1:].lower() in SUFFIXES
+
+    @staticmethod
+    def read(path):
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        if b'\0' in data[:8192]:
+            return None
+        for encoding in ['utf-8', 'gbk']:
+            try:
+                return data.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+        return data.decode('utf-8', 'replace')
+
+    def start(self, base):
+        self.base = base
+        self.thread = threading.Thread(target=self.run, name='ContentIndex', daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, root, listing):
+        '''提交一个目录等待索引, listing为None表示目录已删除'''
+        with self.cond:
+            self.queue.pop(root, None)
+            self.queue[root] = listing
+            self.cond.notify()
+
+    def prune(self):
+        with self.cond:
+            self.pruning = True
+            self.cond.notify()
+
+    def run(self):
+        conn = self.connect()
+        with ThreadPoolExecutor(self.workers) as executor:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.pruning:
+                        self.cond.wait()
+                    if self.queue:
+                        root, listing = self.queue.popitem(last=False)
+                        pruning = False
+                    else:
+                        root = listing = None
+                        pruning, self.pruning = self.pruning, False
+                try:
+                    if pruning:
+                        self.do_prune(conn)
+                    elif listing is None:
+                        self.remove(conn, str(root.relative_to(self.base)))
+                    else:
+                        self.update(conn, executor, root, listing)
+                except Exception as e:
+                    self.logger.warning(f'content index {root or "prune"} failed: {e}')
+
+    def update(self, conn, executor, root, listing):
+        rows = {name: (id, mtime, size) for id, name, mtime, size in
+                conn.execute('SELECT id, name, mtime, size FROM files WHERE dir = ?', (listing.rel,))}
+        changed = []
+        for i, name in enumerate(listing.names):
+            if listing.dirs[i] or not self.accept(name, listing.sizes[i]):
+                continue
+            row = rows.pop(name, None)
+            if row and row[1] == listing.mtimes[i] and row[2] == listing.sizes[i]:
+                continue
+            changed.append((row[0] if row else None, name, listing.mtimes[i], listing.sizes[i]))
+        if not changed and not rows:
+            return
+        bodies = executor.map(self.read, [root / x[1] for x in changed])
+        with conn:
+            for id, _, _ in rows.values():
+                conn.execute('DELETE FROM content WHERE rowid = ?', (id,))
+                conn.execute('DELETE FROM files WHERE id = ?', (id,))
+            for (id, name, mtime, size), body in zip(changed, bodies):
+                if id:
+                    conn.execute('DELETE FROM content WHERE rowid = ?', (id,))
+                    conn.execute('UPDATE files SET mtime = ?, size = ? WHERE id = ?', (mtime, size, id))
+                else:
+                    id = conn.execute('INSERT INTO files (dir, name, mtime, size) VALUES (?, ?, ?, ?)',
+                                      (listing.rel, name, mtime, size)).lastrowid
+                if body is not None:
+                    conn.execute('INSERT INTO content (rowid, body) VALUES (?, ?)', (id, body))
+
+    def remove(self, conn, rel):
+        where = 'dir = ? OR substr(dir, 1, ?) = ?'
+        args = (rel, len(rel) + 1, rel + '/')
+        with conn:
+            conn.execute(f'DELETE FROM content WHERE rowid IN (SELECT id FROM files WHERE {where})', args)
+            conn.execute(f'DELETE FROM files WHERE {where}', args)
+
+    def do_prune(self, conn):
+        for rel, in conn.execute('SELECT DISTINCT dir FROM files').fetchall():
+            if not (self.base / rel).is_dir():
+                self.remove(conn, rel)
+
+    def search(self, query, scope=None, offset=0, size=50, limit=10000):
+        '''按query.terms全文检索, 返回(结果, 命中数), 结果为(dir, name, mtime, size, snippet)
+        snippet已做html转义, 命中部分以<em>标记
+        '''
+        if not self.filename.exists():
+            return [], 0
+        where, args = [], []
+        phrases = [x for x in query.terms if len(x) >= 3]
+        if phrases:
+            where.append('content MATCH ?')
+            args.append(' AND '.join('"' + x.replace('"', '""') + '"' for x in phrases))
+        for term in query.terms:
+            if len(term) < 3:
+                where.append("content.body LIKE ? ESCAPE '\\'")
+                args.append('%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if not where:
+            return [], 0
+        if scope:
+            where.append('(f.dir = ? OR substr(f.dir, 1, ?) = ?)')
+            args.extend([scope, len(scope) + 1, scope + '/'])
+        if query.exts:
+            where.append('(' + ' OR '.join('lower(substr(f.name, -?)) = ?' for _ in query.exts) + ')')
+            for ext in query.exts:
+                args.extend([len(ext), ext])
+        for column, (low, high) in [('size', query.size or (None, None)), ('mtime', query.mtime or (None, None))]:
+            if low is not None:
+                where.append(f'f.{column} >= ?')
+                args.append(low)
+            if high is not None:
+                where.append(f'f.{column} <= ?')
+                args.append(high)
+        sql = f'FROM content JOIN files f ON f.id = content.rowid WHERE {" AND ".join(where)}'
+        total, = self.reader.execute(f'SELECT count(*) FROM (SELECT 1 {sql} LIMIT ?)', args + [limit]).fetchone()
+        rows = self.reader.execute(
+            f"SELECT f.dir, f.name, f.mtime, f.size, snippet(content, 0, char(2), char(3), '...', 24) {sql} "
+            'ORDER BY rank LIMIT ? OFFSET ?', args + [size, offset]).fetchall()
+        return [(dir, name, mtime, size, self.highlight(snippet)) for dir, name, mtime, size, snippet in rows], total
+
+    @staticmethod
+    def highlight(snippet):
+        return tornado.escape.xhtml_escape(snippet or '').replace('\x02', '<em>').replace('\x03', '</em>')
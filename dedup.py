@@ -0,0 +1,126 @@
+# cython: language_level=3
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+__all__ = ['DedupStore']
+
+
+class DedupStore:
+    '''按内容去重: objects/<md5前2位>/<md5>-<size>是每份内容的一个硬链接, 用户目录中相同内容的文件都链接到它
+    上传前已知md5时先给出challenge(文件中随机的一段), 上传者答对这段的md5且内容已存在才直接链接到目标路径(秒传),
+    只知道md5和大小拿不到别人的文件, 也无法判断内容是否存在; 上传完成后发现重复则用硬链接替换新写入的文件
+    命中次数等计数保存在dedup.db中, 多个进程可以一起累加
+    '''
+
+    def __init__(self, directory, min_size=1 << 20):
+        self.directory = Path(directory)
+        self.objects = self.directory / 'objects'
+        self.filename = self.directory / 'dedup.db'
+        self.min_size = min_size
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            conn = self.local.conn = sqlite3.connect(self.filename, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        return conn
+
+    def incr(self, **kwargs):
+        with self.conn as conn:
+            for name, value in kwargs.items():
+                conn.execute('INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?',
+                             (name, value, value))
+
+    def path(self, md5, size):
+        if not re.fullmatch('[0-9a-f]{32}', md5 or ''):
+            return None
+        return self.objects / md5[:2] / f'{md5}-{size}'
+
+    @staticmethod
+    def replace(src, target):
+        '''把target原子地换成src的硬链接'''
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f'.{target.name}.{os.urandom(4).hex()}')
+        os.link(src, tmp)
+        os.replace(tmp, target)
+
+    def challenge(self, size, length=64 << 10):
+        '''秒传前要求上传者回答的范围(offset, length)'''
+        length = min(size, length)
+        return random.SystemRandom().randint(0, size - length), length
+
+    def link(self, md5, size, target, offset, length, proof):
+        '''内容已存在, 大小没变, 且proof等于其中[offset, offset + length)的md5时把target链接到它并返回True, 即秒传'''
+        path = self.path(md5, size)
+        if size < self.min_size or not path or not 0 <= offset <= offset + length <= size:
+            return False
+        try:
+            with open(path, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size != size:
+                    return False
+                fp.seek(offset)
+                if hashlib.md5(fp.read(length)).hexdigest() != proof:
+                    return False
+            self.replace(path, target)
+        except OSError:
+            return False
+        self.incr(uploads=1, hits=1, instant=size)
+        return True
+
+    def add(self, md5, size, target):
+        '''登记上传完成的文件: 已有相同内容时把target换成硬链接, 释放刚写入的数据, 否则把target加入存储'''
+        path = self.path(md5, size)
+        if size < self.min_size or not path:
+            return False
+        try:
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                st = None
+            if st and st.st_size == size:
+                if not os.path.samefile(path, target):
+                    self.replace(path, target)
+                self.incr(uploads=1, hits=1)
+                return True
+            # 大小不符说明存储中的内容已被改过, 用新文件替换
+            self.replace(target, path)
+        except OSError:
+            return False
+        self.incr(uploads=1)
+        return False
+
+    def sweep(self):
+        '''删除已经没有用户文件链接的内容'''
+        if not self.objects.exists():
+            return
+        for entry in self.objects.glob('*/*'):
+            try:
+                if entry.stat().st_nlink <= 1:
+                    entry.unlink()
+            except OSError:
+                pass
+
+    def stats(self):
+        objects = links = saved = 0
+        if self.objects.exists():
+            for entry in self.objects.glob('*/*'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                objects += 1
+                links += max(st.st_nlink - 1, 0)
+                saved += max(st.st_nlink - 2, 0) * st.st_size
+        stats = dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+        uploads, hits = stats.get('uploads', 0), stats.get('hits', 0)
+        return {'objects': objects, 'links': links, 'saved': saved, 'uploads': uploads, 'hits': hits,
+                'instant': stats.get('instant', 0), 'hit_rate': hits / uploads if uploads else 0}
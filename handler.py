@@ -2,8 +2,6 @@
 import asyncio
 import datetime
 import functools
-import hashlib
-import io
 import json
 import math
 import os
@@ -21,14 +19,35 @@ from pathlib import Path
 import markdown
 import tornado.web
 import yaml
+from archive import FORMATS, StoredZip, fingerprint, write_archive, zstandard
 from bson import ObjectId
+from listing import Query
+from tornado import httputil
 from tornado.concurrent import run_on_executor
+from tornado.iostream import StreamClosedError
 from tornado_utils import BaseHandler, Blueprint
 from tornado.web import HTTPError
-from utils import Dict
+from upload import ChunkedUpload, MultipartParser
+from utils import Dict, JSONEncoder
 
 bp = Blueprint(__name__)
 
+
+def parse_range(value, size):
+    '''解析单段Range(bytes=a-b, bytes=a-, bytes=-n), 返回[start, end), start >= end表示无法满足
+    多段或格式不对时返回None, 按整个内容发送
+    '''
+    m = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', value)
+    if not m or not (m[1] or m[2]):
+        return None
+    if not m[1]:
+        return max(size - int(m[2]), 0), size
+    start = int(m[1])
+    if m[2] and int(m[2]) < start:
+        return None
+    return start, min(int(m[2]) + 1, size) if m[2] else size
+
+
 def check_auth(method):
     @functools.wraps(method)
     async def wrapper(self, name, *args, **kwargs):
@@ -58,6 +77,8 @@ def check_auth(method):
 class BaseHandler(BaseHandler):
 
     executor = ThreadPoolExecutor(10)
+    archiver = ThreadPoolExecutor(32)
+    archive_etag = None
 
     default = {
         'ppt.png': ['.ppt', '.pptx'],
@@ -95,6 +116,96 @@ class BaseHandler(BaseHandler):
         for v in value:
             icon[v] = key
 
+    async def send_chunk(self, data):
+        self.write(data)
+        await self.flush()
+
+    async def download(self, root, cache=False, include_body=True):
+        '''流式打包下载目录, 压缩在archiver线程中进行, 每块数据发给客户端后才继续压缩
+        format: zip(默认)|tar|tar.zst, compress: none|fast|best
+        zip在compress=none或未指定compress且不缓存时不压缩, 输出确定, 支持HEAD/Range/ETag续传(如wget -c, axel)
+        cache为True时按目录内容指纹缓存压缩包, 再次下载时作为静态文件发送, 同样支持Range和ETag
+        '''
+        loop = asyncio.get_running_loop()
+        fmt = self.args.format if self.args.format in FORMATS else 'zip'
+        compress = self.args.compress if self.args.compress in ['none', 'fast', 'best'] else None
+        if fmt == 'tar.zst' and not zstandard:
+            self.set_header('Content-Type', 'application/json')
+            self.clear_header('Content-Disposition')
+            return self.finish({'err': 1, 'msg': '服务端未安装zstandard, 不支持tar.zst'})
+        filename = urllib.parse.quote(root.name)
+        self.set_header('Content-Disposition', f'attachment;filename={filename}.{fmt}')
+        cache = cache and self.app.archives
+        if fmt == 'zip' and (compress == 'none' or (compress is None and not cache)):
+            return await self.send_stored(root, include_body)
+        fp = None
+        if cache:
+            digest = await loop.run_in_executor(self.executor, fingerprint, root)
+            key = f'{root.relative_to(self.app.root)}|{compress}|{digest}.{fmt}'
+            path = self.app.archives.get(key)
+            if path:
+                self.archive_etag = f'"{path.stem}"'
+                return await tornado.web.StaticFileHandler.get(self, str(path.relative_to(self.app.root)))
+            fp = self.app.archives.claim(key)
+
+        def write(data):
+            if fp:
+                fp.write(data)
+            asyncio.run_coroutine_threadsafe(self.send_chunk(data), loop).result()
+
+        try:
+            await loop.run_in_executor(self.archiver, write_archive, root, write,
+                                       fmt, compress, self.app.compressor, self.app.archive_workers)
+        except BaseException as e:
+            if fp:
+                self.app.archives.abort(fp)
+            if isinstance(e, StreamClosedError):
+                return
+            raise
+        if fp:
+            await loop.run_in_executor(self.executor, self.app.archives.commit, key, fp)
+        self.finish()
+
+    async def send_stored(self, root, include_body=True):
+        '''发送不压缩的zip, 长度和内容可以预先确定, 因此支持HEAD/Range/If-Range/ETag, 断点续传不必重新打包'''
+        loop = asyncio.get_running_loop()
+        archive = await loop.run_in_executor(self.executor, StoredZip, root, self.app.crcs)
+        self.archive_etag = archive.etag
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+
+        size = archive.size
+        start, end = 0, size
+        request_range = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if request_range and (not if_range or if_range == archive.etag):
+            request_range = parse_range(request_range, size)
+            if request_range:
+                start, end = request_range
+                if start >= end:
+                    self.set_status(416)
+                    self.set_header('Content-Type', 'text/plain')
+                    self.set_header('Content-Range', f'bytes */{size}')
+                    return self.finish()
+                if start != 0 or end != size:
+                    self.set_status(206)
+                    self.set_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.set_header('Content-Length', end - start)
+        if not include_body:
+            return self.finish()
+
+        def write(data):
+            asyncio.run_coroutine_threadsafe(self.send_chunk(data), loop).result()
+
+        try:
+            await loop.run_in_executor(self.archiver, archive.read, start, end, write)
+        except StreamClosedError:
+            return
+        self.finish()
+
     @staticmethod
     def convert_size(size):
         if size / (1024 * 1024 * 1024.0) >= 1:
@@ -228,7 +339,8 @@ class ShareHandler(BaseHandler):
                 query = self.get_args()
                 docs = await self.query('share', {'token': token,'name':{'$regex': re.compile(query.q)}}) if query.q else await self.query('share', {'token': token})
                 entries = []
-                for doc in docs:
+                nums = await self.rd.mget([f'{self.prefix}:NUM:{doc.name}' for doc in docs]) if docs else []
+                for doc, num in zip(docs, nums):
                     path = self.root / doc.name
                     if doc.expired_at and doc.expired_at < datetime.datetime.now() or not path.exists():
                         Id = str(doc._id)
@@ -246,7 +358,7 @@ class ShareHandler(BaseHandler):
                             'expired_at': doc.expired_at,
                             'shared': True,
                             'link': (await self.rd.get(f'{self.prefix}:LINK:{str(doc._id)}')),
-                            'num': int((await self.rd.get(f'{self.prefix}:NUM:{doc.name}')).encode()) if await self.rd.exists(f'{self.prefix}:NUM:{doc.name}') else 0
+                            'num': int(num) if num else 0
                         }))
 
                 if self.args.sort == 'time':
@@ -273,52 +385,31 @@ class XabcHandler(tornado.web.StaticFileHandler, BaseHandler):
         BaseHandler.__init__(self, application, request, path=self.app.root)
 
     def compute_etag(self):
+        if self.archive_etag:
+            return self.archive_etag
         if hasattr(self, 'absolute_path'):
             return super().compute_etag()
 
     async def prepare(self):
         path = self.root / self.request.path[6:]
-        if self.request.method in ['POST'] and path in self.cache:
-            self.cache.pop(path)
-        elif self.request.method in ['PUT', 'DELETE', 'HEAD'] and path.parent in self.cache:
-            self.cache.pop(path.parent)
-
         if self.request.method == 'PUT':
             self.received = 0
             self.process = 0
-            self.request.headers.pop('Content-Type')
+            self.request.headers.pop('Content-Type', None)
             self.length = int(self.request.headers['Content-Length'])
             if str(path).find('..') >= 0:
                 return self.finish('target is forbidden\n')
             if path.is_dir():
                 return self.finish('target is directory\n')
             path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists() and path.stat().st_nlink > 1:
+                # 去重后的文件与其他副本共用inode, 先断开链接再写, 以免改动所有副本
+                path.unlink()
             self.fp = open(path, 'wb')
-        else:
-            XabcHandler._stream_request_body = False
+            self.app.invalidate(path.parent)
+            self.request.connection.set_max_body_size(1 << 40)
         await super().prepare()
 
-    @run_on_executor
-    def download(self, root):
-        new_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(new_loop)
-        filename = urllib.parse.quote(root.name)
-        try:
-            stream = io.BytesIO()
-            zf = zipfile.ZipFile(stream, 'a', zipfile.ZIP_DEFLATED, True)
-            for f in root.rglob('*'):
-                if f.is_file():
-                    zf.writestr(f'{root.name}/{f.relative_to(root)}', f.read_bytes())
-            for zfile in zf.filelist:
-                zfile.create_system = 0
-            zf.close()
-            data = stream.getvalue()
-            stream.close()
-            self.set_header('Content-Disposition', f'attachment;filename={filename}.zip')
-            self.finish(data)
-        except:
-            self.finish("")
-
     async def send(self, name, include_body=True):
         if include_body and self.app.options.auth:
             doc = await self.db.files.find_one({'name': name})
@@ -360,7 +451,7 @@ class XabcHandler(tornado.web.StaticFileHandler, BaseHandler):
             if path.is_file():
                 await self.send(doc.name, include_body)
             else:
-                await self.download(path)
+                await self.download(path, cache=True, include_body=include_body)
 
 @bp.route('/disk/?(.*)')
 @bp.route('/file/?(.*)')
@@ -372,6 +463,8 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
         BaseHandler.__init__(self, application, request, path=self.app.root)
 
     def compute_etag(self):
+        if self.archive_etag:
+            return self.archive_etag
         if hasattr(self, 'absolute_path'):
             return super().compute_etag()
 
@@ -382,27 +475,70 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             self.set_header('content-type', 'application/octet-stream')
     async def prepare(self):
         path = self.root / self.request.path[6:]
-        if self.request.method in ['POST'] and path in self.cache:
-            self.cache.pop(path)
-        elif self.request.method in ['PUT', 'DELETE', 'HEAD'] and path.parent in self.cache:
-            self.cache.pop(path.parent)
-
+        if self.forbidden(self.request.path[6:], self.path_args[0] if self.path_args else ''):
+            raise HTTPError(404)
+        self.started = time.time() - 1
         if self.request.method == 'PUT':
             self.received = 0
             self.process = 0
-            self.request.headers.pop('Content-Type')
+            self.request.headers.pop('Content-Type', None)
             self.length = int(self.request.headers['Content-Length'])
             if str(path).find('..') >= 0:
                 return self.finish('target is forbidden\n')
             if path.is_dir():
                 return self.finish('target is directory\n')
             path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists() and path.stat().st_nlink > 1:
+                # 去重后的文件与其他副本共用inode, 先断开链接再写, 以免改动所有副本
+                path.unlink()
             self.fp = open(path, 'wb')
-        else:
-            DiskHandler._stream_request_body = False
+            self.request.connection.set_max_body_size(1 << 40)
+        elif self.request.method == 'POST':
+            self.files = {}
+            self.parser = None
+            content_type = self.request.headers.get('Content-Type', '')
+            if content_type.startswith('multipart/form-data'):
+                for field in content_type.split(';'):
+                    k, _, v = field.strip().partition('=')
+                    if k == 'boundary' and v:
+                        length = int(self.request.headers.get('Content-Length', 0))
+                        if not self.app.uploads.available(length):
+                            return self.finish({'err': 1, 'msg': '磁盘空间不足'})
+                        self.parser = MultipartParser(v.encode(), self.app.upload_tmp)
+                        self.request.connection.set_max_body_size(1 << 40)
         await super().prepare()
 
+    def on_finish(self):
+        if getattr(self, 'parser', None):
+            self.parser.cleanup()
+
+    def forbidden(self, *names):
+        '''root以外的路径, 以及.filelist下的内部文件(去重存储/索引/上传暂存等)不可访问'''
+        for name in names:
+            path = Path(os.path.abspath(self.root / (name or '')))
+            if not path.is_relative_to(self.root) or '.filelist' in path.relative_to(self.root).parts:
+                return True
+        return False
+
+    def changed(self, *paths):
+        '''修改成功后使paths所在的目录失效, 本次请求中新建或改动过的上级目录也一起(上一级列表中的mtime随之变化)'''
+        roots = set()
+        for path in paths:
+            root = path.parent
+            while root not in roots:
+                roots.add(root)
+                try:
+                    if root == self.root or os.stat(root).st_mtime < self.started:
+                        break
+                except OSError:
+                    break
+                root = root.parent
+        for root in roots:
+            self.app.invalidate(root)
+
     def data_received(self, chunk):
+        if self.request.method == 'POST':
+            return self.receive(chunk)
         self.received += len(chunk)
         process = int(self.received / self.length * 100)
         if process > self.process + 5:
@@ -413,68 +549,125 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
 
     async def put(self, name):
         self.fp.close()
+        self.changed(self.root / name)
         self.finish('upload succeed\n')
 
+    def receive(self, chunk):
+        '''POST请求体: multipart的文件边接收边写入临时文件, 其他请求体照常缓存在内存中'''
+        if not self.parser:
+            self.request.body += chunk
+            return
+        try:
+            self.parser.feed(chunk)
+        except ValueError as e:
+            raise HTTPError(400, reason=str(e))
+
+    def body_received(self):
+        '''请求体接收完毕后解析表单参数, 并重新生成self.args'''
+        if self.parser:
+            if not self.parser.done:
+                raise HTTPError(400, reason='incomplete multipart body')
+            for part in self.parser.parts:
+                if part.filename is None:
+                    self.request.body_arguments.setdefault(part.name, []).append(bytes(part.value))
+                    self.request.arguments.setdefault(part.name, []).append(bytes(part.value))
+                else:
+                    self.files.setdefault(part.name, []).append(part)
+        else:
+            httputil.parse_body_arguments(self.request.headers.get('Content-Type', ''), self.request.body,
+                                          self.request.body_arguments, self.request.files, self.request.headers)
+            for k, v in self.request.body_arguments.items():
+                self.request.arguments.setdefault(k, []).extend(v)
+        self.get_args()
+
     @run_on_executor
     def search(self, name):
-        entries = []
-        q = self.args.q.lower()
-        tmp = self.app.cache.copy()
-        for key, files in tmp.items():
-            for doc in files[1]:
-                if doc.path.name.lower().find(q) >= 0:
-                    if self.app.options.auth and not str(doc.path).startswith(name):
-                        continue
-                    entries.append(doc)
+        scopes = [None]
+        if self.app.options.auth:
+            scopes = [name.strip('/') or None]
+            if scopes[0] == str(self.current_user.id):
+                scopes.append('0')
+        query = Query(self.args.q)
         doc = self.get_args(page=1, size=50)
-        self.args.total = len(entries)
-        self.args.pages = int(math.ceil(len(entries) / doc.size))
+        key = (tuple(scopes), query.key)
+        generation = self.app.generation(scopes)
+        result = self.app.results.get(key, generation)
+        if result is None:
+            hits = (entry for scope in scopes for entry in self.app.search(query, scope))
+            limit = self.app.options.search_limit
+            result = query.top(hits, limit or float('inf'), limit)
+            self.app.results.set(key, generation, result)
+        entries, total, self.args.truncated = result
+        self.args.total = total
+        self.args.pages = int(math.ceil(total / doc.size))
         entries = entries[(doc.page - 1) * doc.size:doc.page * doc.size]
+        self.app.load_nums(entries)
         return entries
 
+    def get_order(self, entries):
+        if self.args.sort in ['time', 'size', 'num']:
+            sort, reverse = self.args.sort, self.args.order == - 1
+        else:
+            sort, reverse = 'time', self.args.order == 1
+        if sort == 'num':
+            self.app.load_nums(entries)
+        return sort, reverse, entries.order(sort, reverse)
+
+    @run_on_executor
+    def search_content(self, name):
+        scope = (name.strip('/') or None) if self.app.options.auth else None
+        doc = self.get_args(page=1, size=50)
+        rows, total = self.app.content.search(Query(self.args.q), scope, (doc.page - 1) * doc.size, doc.size, self.app.options.search_limit)
+        self.args.total = total
+        self.args.pages = int(math.ceil(total / doc.size))
+        return [Dict({'path': Path(dir, name), 'mtime': mtime, 'size': size, 'is_dir': False, 'num': 0, 'snippet': snippet})
+                for dir, name, mtime, size, snippet in rows]
+
     @run_on_executor
     def listdir(self, root):
         entries = self.app.scan_dir(root)
         doc = self.get_args(page=1, size=50, order=1)
-        if self.args.sort == 'time':
-            entries.sort(key=lambda x: x.mtime, reverse=(self.args.order == - 1))
-        elif self.args.sort == 'size':
-            entries.sort(key=lambda x: x.size, reverse=(self.args.order == - 1))
-        elif self.args.sort == 'num':
-            entries.sort(key=lambda x: x.num, reverse=(self.args.order == - 1))
-        else:
-            entries.sort(key=lambda x: x.mtime,reverse=(self.args.order == 1))
+        sort, reverse, order = self.get_order(entries)
+        start = entries.seek(order, sort, reverse, doc.cursor) if doc.cursor else (doc.page - 1) * doc.size
+        page = order[start:start + doc.size]
         self.args.total = len(entries)
         self.args.pages = int(math.ceil(len(entries) / doc.size))
-        entries = entries[(doc.page - 1) * doc.size:doc.page * doc.size]
+        self.args.cursor = entries.cursor(page[-1], sort) if page and start + len(page) < len(order) else None
+        entries = [entries[i] for i in page]
+        if sort != 'num':
+            self.app.load_nums(entries)
         return entries
 
     @run_on_executor
-    def download(self, root):
-        new_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(new_loop)
-        filename = urllib.parse.quote(root.name)
-        try:
-            stream = io.BytesIO()
-            zf = zipfile.ZipFile(stream, 'a', zipfile.ZIP_DEFLATED, True)
-            for f in root.rglob('*'):
-                if f.is_file():
-                    zf.writestr(f'{root.name}/{f.relative_to(root)}', f.read_bytes())
-            for zfile in zf.filelist:
-                zfile.create_system = 0
-            zf.close()
-            data = stream.getvalue()
-            stream.close()
-            self.set_header('Content-Disposition', f'attachment;filename={filename}.zip')
-            self.finish(data)
-        except:
-            self.finish("")
+    def open_stream(self, root):
+        entries = self.app.scan_dir(root)
+        self.get_args(order=1)
+        sort, reverse, order = self.get_order(entries)
+        start = entries.seek(order, sort, reverse, self.args.cursor) if self.args.cursor else 0
+        return entries, sort, order[start:]
+
+    @run_on_executor
+    def dump_chunk(self, entries, sort, order):
+        chunk = [entries[i] for i in order]
+        if sort != 'num':
+            self.app.load_nums(chunk)
+        return ''.join(json.dumps(doc.dict(), cls=JSONEncoder, ensure_ascii=False) + '\n' for doc in chunk)
+
+    async def stream(self, root, size=1000):
+        '''按行输出目录下的全部条目(ndjson), 每size条flush一次, 内存占用与目录大小无关
+        '''
+        entries, sort, order = await self.open_stream(root)
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        for i in range(0, len(order), size):
+            self.write(await self.dump_chunk(entries, sort, order[i:i + size]))
+            await self.flush()
+        self.finish()
 
     def get_nodes(self, root):
         nodes = []
         key = self.app.root / root
         if key in self.app.cache:
-            entries = self.app.cache[key][1]
+            entries = self.app.cache[key]
             for doc in entries:
                 if doc.is_dir:
                     nodes.append({'title': doc.path.name, 'href': f'/disk/{doc.path}', 'children': self.get_nodes(doc.path)})
@@ -601,7 +794,10 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
     @check_auth
     async def get(self, name, include_body=True):
         path = self.root / name
-        if self.args.q:
+        if self.args.q and self.args.content and self.app.content:
+            entries = await self.search_content(name)
+            self.render('index.html', entries=entries, absolute=True)
+        elif self.args.q:
             entries = await self.search(name)
             self.render('index.html', entries=entries, absolute=True)
         elif self.args.f == 'tree':
@@ -610,6 +806,8 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
         elif self.args.f == 'info':
             info = await self.get_info(name)
             self.finish(info)
+        elif self.args.f == 'ndjson' and path.is_dir():
+            await self.stream(path)
         elif self.request.path.startswith('/file/') or self.args.f == 'download' or re.match('wget|curl|axel', self.ua.lower()):
             self.app.options.auth and await self.rd.incr(f'{self.prefix}:NUM:{name}')
             self.set_header('Content-Type', 'application/octet-stream')
@@ -617,7 +815,7 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             if path.is_file():
                 await self.send(name, include_body)
             else:
-                await self.download(path)
+                await self.download(path, include_body=include_body)
         elif path.is_file() and self.args.f == 'preview':
             self.app.options.auth and await self.rd.incr(f'{self.prefix}:NUM:{name}')
             suffix = path.suffix.lower()[1:]
@@ -672,54 +870,136 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             await self.send(name, include_body)
         else:
             entries = await self.listdir(path)
-            self.render('index.html', entries=entries, absolute=False)
+            self.render('index.html', entries=entries, absolute=False, cursor=self.args.cursor)
 
     async def merge(self, path):
-        dirname = Path(f'/tmp/upload/{self.args.guid}-{self.args.id}')
+        loop = asyncio.get_running_loop()
+        dirname = self.app.upload_tmp / f'{self.args.guid}-{self.args.id}'
         filename = path / urllib.parse.unquote(self.args.name)
+        if self.forbidden(filename):
+            return self.finish({'err': 1, 'msg': '目标路径不可用'})
         filename.parent.mkdir(parents=True, exist_ok=True)
-        chunks = int(list(dirname.glob("*"))[0].name.split('_')[0])
-        md5 = hashlib.md5()
-        with filename.open('wb') as fp:
-            for i in range(int(chunks)):
-                chunk = dirname / f'{chunks}_{i}'
-                if not chunk.exists():
-                    return self.finish({'err': 1, 'msg': f'缺少分片: {i}'})
-                data = chunk.read_bytes()
-                md5.update(data)
-                fp.write(data)
-        md5 = md5.hexdigest()
+        markers = list(dirname.glob('*_*'))
+        if not markers:
+            return self.finish({'err': 1, 'msg': '缺少分片: 0'})
+        chunks = int(markers[0].name.split('_')[0])
+        chunked = ChunkedUpload(dirname)
+        missing = chunked.missing(chunks)
+        if missing is not None:
+            return self.finish({'err': 1, 'msg': f'缺少分片: {missing}'})
+        md5 = await loop.run_in_executor(self.executor, chunked.md5, chunks)
         if self.args.md5 and self.args.md5 != 'undefined' and self.args.md5 != md5:
             self.finish({'err': 1, 'msg': 'md5校验失败'})
         else:
-            shutil.rmtree(dirname)
-            self.finish({'err': 0, 'path': filename.relative_to(self.app.root)})
+            await loop.run_in_executor(self.executor, chunked.commit, filename)
+            if self.app.dedup:
+                await loop.run_in_executor(self.executor, self.app.dedup.add, md5, chunked.size, filename)
+            self.changed(filename)
+            self.finish({'err': 0, 'path': filename.relative_to(self.app.root), 'md5': md5})
+
+    async def session(self, path):
+        '''上传会话: session创建或恢复, 携带session和chunk上传分片, parts查询已收到的分片, complete合并, abort放弃
+        instant秒传: 带上session返回的challenge范围内容的md5(proof)'''
+        loop = asyncio.get_running_loop()
+        if self.args.action == 'session':
+            name = urllib.parse.unquote(self.args.name or '').strip('/')
+            if not name or '..' in name.split('/') or not str(self.args.size).isdigit():
+                return self.finish({'err': 1, 'msg': '缺少文件名或大小'})
+            if self.forbidden(path / name):
+                return self.finish({'err': 1, 'msg': '目标路径不可用'})
+            chunk_size = min(max(int(self.args.chunk_size or 5 << 20), 64 << 10), 256 << 20)
+            if not self.app.uploads.get(self.args.session) and not self.app.uploads.available(int(self.args.size)):
+                return self.finish({'err': 1, 'msg': '磁盘空间不足'})
+            session = self.app.uploads.create(str((path / name).relative_to(self.app.root)), int(self.args.size),
+                                              chunk_size, self.args.md5, self.args.resume)
+            ret = {'err': 0, 'dedup': bool(self.app.dedup), **session.dict()}
+            if self.app.dedup and self.args.md5 and session.size >= self.app.dedup.min_size:
+                # 不论内容是否存在都给出challenge, 答对后才能秒传(action=instant)
+                if session.meta.get('md5') != self.args.md5 or not session.meta.get('challenge'):
+                    session.meta.update(md5=self.args.md5, challenge=self.app.dedup.challenge(session.size))
+                    await loop.run_in_executor(self.executor, session.save)
+                ret['challenge'] = session.meta['challenge']
+            return self.finish(ret)
+
+        session = self.app.uploads.get(self.args.session)
+        if not session or not (self.app.root / session.path).is_relative_to(path):
+            return self.finish({'err': 1, 'msg': '上传会话不存在或已过期'})
+        if self.args.action == 'parts':
+            self.finish({'err': 0, **session.dict()})
+        elif self.args.action == 'abort':
+            await loop.run_in_executor(self.executor, session.abort)
+            self.finish({'err': 0})
+        elif self.args.action == 'instant':
+            md5, challenge = session.meta.get('md5'), session.meta.get('challenge')
+            if not self.app.dedup or not challenge or not await loop.run_in_executor(
+                    self.executor, self.app.dedup.link, md5, session.size, self.app.root / session.path, *challenge, self.args.proof):
+                return self.finish({'err': 0, 'instant': False, **session.dict()})
+            await loop.run_in_executor(self.executor, session.abort)
+            self.changed(self.app.root / session.path)
+            self.finish({'err': 0, 'path': session.path, 'md5': md5, 'instant': True})
+        elif self.args.action == 'complete':
+            missing = session.missing(session.chunks)
+            if missing is not None:
+                return self.finish({'err': 1, 'msg': f'缺少分片: {missing}', 'parts': session.parts()})
+            md5 = await loop.run_in_executor(self.executor, session.md5, session.chunks)
+            expected = self.args.md5 or session.meta.get('md5')
+            if expected and expected != 'undefined' and expected != md5:
+                return self.finish({'err': 1, 'msg': 'md5校验失败'})
+            filename = self.app.root / session.path
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            await loop.run_in_executor(self.executor, session.commit, filename)
+            if self.app.dedup:
+                await loop.run_in_executor(self.executor, self.app.dedup.add, md5, session.size, filename)
+            self.changed(filename)
+            self.finish({'err': 0, 'path': session.path, 'md5': md5})
+        elif self.args.chunk and self.files.get('file'):
+            try:
+                await loop.run_in_executor(self.executor, session.write, int(self.args.chunk), self.files['file'][0].path)
+            except (ValueError, OSError) as e:
+                return self.finish({'err': 1, 'msg': str(e)})
+            self.finish({'err': 0})
+        else:
+            self.finish({'err': 1, 'msg': 'files not found'})
+
     async def upload(self, path):
         if not self.app.options.upload:
             raise tornado.web.HTTPError(403)
 
         if self.args.action == 'merge':
             await self.merge(path)
+        elif self.args.action in ['session', 'parts', 'complete', 'abort', 'instant'] or self.args.session:
+            await self.session(path)
         elif self.args.chunks and self.args.chunk:
-            filename = Path(f'/tmp/upload/{self.args.guid}-{self.args.id}/{self.args.chunks}_{self.args.chunk}')
-            filename.parent.mkdir(parents=True, exist_ok=True)
-            filename.write_bytes(self.request.files['file'][0].body)
+            if not self.files.get('file'):
+                return self.finish({'err': 1, 'msg': 'files not found'})
+            if not self.args.size:
+                return self.finish({'err': 1, 'msg': '缺少文件大小: size'})
+            chunked = ChunkedUpload(self.app.upload_tmp / f'{self.args.guid}-{self.args.id}', int(self.args.size))
+            # size由客户端给出, 预分配前先确认暂存盘放得下
+            if not chunked.data.exists() and not self.app.uploads.available(chunked.size):
+                return self.finish({'err': 1, 'msg': '磁盘空间不足'})
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, chunked.write, int(self.args.chunks), int(self.args.chunk), self.files['file'][0].path)
+            except (ValueError, OSError) as e:
+                return self.finish({'err': 1, 'msg': str(e)})
             if self.app.options.auth and int(self.args.chunk) == 0:
                 await self.rd.setex(f'{self.prefix}:UPLOAD_FLAG',4900,1)
                 await self.rd.lpush(f'{self.prefix}:UPLOAD:LIST',f'{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")} {str(path).split(str(self.root))[1][1:]}/{self.args.name}')
                 await self.rd.expire(f'{self.prefix}:UPLOAD:LIST', 43200)
             self.finish({'err': 0})
-        elif self.request.files:
+        elif self.files:
             path.mkdir(parents=True, exist_ok=True)
             urls = []
 
-            for items in self.request.files.values():
+            for items in self.files.values():
                 for item in items:
                     cleaned_filename = re.sub(r'[\s%]+', lambda m: ' ' if m.group().isspace() else '',item.filename)
                     cleaned_path_name = path / urllib.parse.unquote(Path(cleaned_filename).name)
                     cleaned_path_name.parent.mkdir(parents=True, exist_ok=True)
-                    cleaned_path_name.write_bytes(item.body)
+                    shutil.move(item.path, cleaned_path_name)
                     urls.append(cleaned_path_name.relative_to(self.app.root))
+            self.changed(*(self.app.root / url for url in urls))
 
             ret = {'err': 0, 'path': urls[0]}
 
@@ -736,15 +1016,19 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
 
     @check_auth
     async def post(self, name):
+        self.body_received()
         path = self.root / name
         if self.args.action == 'delete' and self.request.headers.get('referer', '').find('/share') >= 0:
             self.logger.info('change action from delete to unshare')
             self.args.action = 'unshare'
-        if not path.exists() and self.args.action and self.args.action not in ['unshare', 'merge']:
+        if not path.exists() and self.args.action and self.args.action not in ['unshare', 'merge', 'session', 'parts', 'complete', 'abort']:
             self.finish({'err': 1, 'msg': f'{name} not exists'})
         elif self.args.action == 'folder':
             folder = path / self.args.name.strip('./')
+            if self.forbidden(folder):
+                return self.finish({'err': 1, 'msg': '目标路径不可用'})
             folder.mkdir(parents=True, exist_ok=True)
+            self.changed(folder)
             self.finish({'err': 0})
         elif self.args.action == 'kindle':
             if not self.current_user.kindle:
@@ -762,10 +1046,16 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             if self.args.filename.find('/') >= 0:
                 return self.finish({'err': 1, 'msg': '文件名不可包含/'})
             new_path = path.parent / self.args.filename
-            if new_path.exists():
+            if self.forbidden(new_path):
+                self.finish({'err': 1, 'msg': '目标路径不可用'})
+            elif new_path.exists():
                 self.finish({'err': 1, 'msg': '文件名重复'})
             else:
                 path.rename(new_path)
+                self.changed(path)
+                if new_path.is_dir():
+                    self.app.invalidate(path, tree=True)
+                self.app.scan_dir(path.parent)
                 self.finish({'err': 0, 'msg': '重命名成功'})
         elif self.args.action == 'move':
             if self.args.dirname.startswith('/'):
@@ -774,12 +1064,19 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
                 dirpath = '/'.join(self.request.path.split('/')[2:- 1])
             new_path = self.root / dirpath / self.args.dirname.strip('/') / path.name
             self.logger.info(f'move {path} to {new_path}')
+            if self.forbidden(new_path):
+                return self.finish({'err': 1, 'msg': '目标路径不可用'})
             if new_path.exists():
                 return self.finish({'err': 1, 'msg': '目标文件已存在'})
             if new_path.parent.is_file():
                 return self.finish({'err': 1, 'msg': '目标文件夹为文件'})
             new_path.parent.mkdir(parents=True, exist_ok=True)
             path.rename(new_path)
+            self.changed(path, new_path)
+            if new_path.is_dir():
+                self.app.invalidate(path, tree=True)
+            self.app.scan_dir(path.parent)
+            self.app.scan_dir(new_path.parent)
             self.finish({'err': 0, 'msg': '已移动至目标文件夹'})
         elif self.args.action == 'public':
             filename = self.root / '0' / path.name
@@ -790,6 +1087,7 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             else:
                 filename.parent.mkdir(parents=True, exist_ok=True)
                 os.symlink(path, filename)
+                self.changed(filename)
                 self.finish({'err': 0, 'msg': f'{name}已分享公共空间'})
         elif self.args.action == 'share':
             url = f'/disk/{name}'
@@ -832,14 +1130,22 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             for url in re.split('[,;\n\t]',self.args.src):
                 filename = urllib.parse.urlparse(url).path.split('/')[-1]
                 filename = path / filename
-                command = f''' axel -U "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15" -n5 '{url}' -o '{filename}' '''
+                # 先下载到临时文件再替换, 已有的目标可能是去重存储的硬链接, 不能就地写入
+                tmp = filename.with_name(f'.{filename.name}.{os.urandom(4).hex()}')
+                command = f''' axel -U "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15" -n5 '{url}' -o '{tmp}' '''
                 p = await asyncio.create_subprocess_shell(command)
                 await p.wait()
                 if p.returncode != 0:
-                    command = f''' wget --no-check-certificate -U "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15" '{url}' -O '{filename}' '''
+                    command = f''' wget --no-check-certificate -U "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15" '{url}' -O '{tmp}' '''
                     p = await asyncio.create_subprocess_shell(command)
                     await p.wait()
                 self.logger.info(f'download result: {p.returncode}, {url}')
+                if p.returncode == 0:
+                    os.replace(tmp, filename)
+                    self.changed(filename)
+                else:
+                    tmp.unlink(missing_ok=True)
+                tmp.with_name(f'{tmp.name}.st').unlink(missing_ok=True)
             self.finish({'err': p.returncode, 'msg': '下载成功' if p.returncode == 0 else '下载失败'})
         elif self.args.action == 'delete':
             await self.delete(name)
@@ -876,13 +1182,13 @@ class DiskHandler(tornado.web.StaticFileHandler, BaseHandler):
             path.unlink()
         else:
             shutil.rmtree(path)
-            self.app.cache.pop(path, None)
+            self.app.invalidate(path)
             if self.app.options.auth:
                 p = await self.rd.pipeline()
                 for i in await self.rd.keys(f'{self.prefix}:*:{name}*'):
                     await p.delete(i)
                 await p.execute()
-        self.app.cache.pop(path.parent, None)
+        self.changed(path)
         self.finish({'err': 0, 'msg': f'{name} 删除成功'})
 
 
@@ -3,21 +3,30 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import datetime
-import collections
 import hashlib
 import secrets
+import stat
 import string
 import psutil
 import logging
+import multiprocessing
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import tornado.process
 from apscheduler.schedulers.background import BackgroundScheduler
+from archive import ArchiveCache, CrcCache
+from content import ContentIndex
+from dedup import DedupStore
 from handler import bp as bp_disk
+from listing import Invalidator, Listing, ListingCache, ResultCache, Snapshot, scan, scan_tree
 from tornado.options import define, options
 from tornado_utils import Application, bp_user
-from utils import AioEmail, AioRedis, Dict, Motor, Request, Redis
+from upload import UploadSessions
+from utils import AioEmail, AioRedis, Motor, Request, Redis, Watcher
 
 define('root', default=os.path.abspath(os.path.dirname(__file__))+'/files', type=str)
 define('auth', default=True if os.environ.get('FILELIST_AUTH') else False, type=bool)
@@ -25,20 +34,76 @@ define('tools', default=False, type=bool)
 define('upload', default=True, type=bool)
 define('delete', default=True, type=bool)
 define('db', default='filelist', type=str)
+define('watch', default=True if os.environ.get('FILELIST_WATCH') else False, type=bool)
+define('cache_mb', default=1024, type=int)
+define('cache_entries', default=0, type=int)
+define('scan_workers', default=0, type=int)
+define('snapshot', default=True, type=bool)
+define('search_limit', default=10000, type=int)
+define('search_cache', default=128, type=int)
+define('content', default=True if os.environ.get('FILELIST_CONTENT') else False, type=bool)
+define('content_max_kb', default=1024, type=int)
+define('content_workers', default=4, type=int)
+define('archive_workers', default=0, type=int)
+define('archive_cache_mb', default=10240, type=int)
+define('upload_ttl', default=24, type=int)
+define('upload_tmp', default='', type=str)
+define('dedup', default=False, type=bool)
 
 class Application(Application):
+    bus = None
 
     def initialize(self):
         logging.getLogger('apscheduler').setLevel(logging.ERROR)
         self.root = Path(options.root).expanduser().absolute()
         self.http = Request(lib='aiohttp')
-        self.cache = collections.defaultdict(list)
+        self.indexer = tornado.process.task_id() in (None, 0)
+        self.cache = ListingCache(options.cache_mb * 1024 * 1024 // (1 if self.indexer else options.workers), options.cache_entries)
         self.mtime = {}
+        self.results = ResultCache(options.search_cache)
+        self.archive_workers = options.archive_workers or os.cpu_count()
+        self.compressor = ThreadPoolExecutor(self.archive_workers)
+        self.archives = ArchiveCache(self.root / '.filelist' / 'archives', options.archive_cache_mb * 1024 * 1024) if options.archive_cache_mb else None
+        self.crcs = CrcCache(self.root / '.filelist' / 'crc.db')
+        self.upload_tmp = Path(options.upload_tmp).expanduser().absolute() if options.upload_tmp else self.root / '.filelist' / 'upload'
+        self.upload_tmp.mkdir(parents=True, exist_ok=True)
+        if self.upload_tmp.stat().st_dev != self.root.stat().st_dev:
+            self.logger.warning(f'{self.upload_tmp} is not on the same filesystem as {self.root}, uploads will be copied instead of renamed')
+        self.uploads = UploadSessions(self.upload_tmp, options.upload_ttl * 3600)
+        self.dedup = DedupStore(self.root / '.filelist' / 'dedup') if options.dedup else None
+        self.invalidated = {}
+        self.stale_before = 0
+        self.build_info = 'pending' if self.indexer else 'shared'
+        self.snapshot = Snapshot(self.root / '.filelist' / 'index.db') if options.snapshot else None
+        self.loaded = False
+        self.content = None
+        if options.content:
+            self.content = ContentIndex(self.root / '.filelist' / 'content.db', options.content_max_kb * 1024, options.content_workers)
+            if self.indexer:
+                self.content.start(self.root)
+        self.loader = threading.Thread(target=self.load, daemon=True) if self.snapshot and self.indexer else None
+        if self.loader:
+            self.loader.start()
         self.sched = BackgroundScheduler()
-        self.sched.add_job(self.scan, 'cron', minute=0, hour='*')
-        self.sched.add_job(self.scan, 'date', run_date=datetime.datetime.now() + datetime.timedelta(seconds=30))
-        if options.auth:
-            self.sched.add_job(self.count,'interval',seconds=3600)
+        if self.indexer:
+            if options.watch:
+                self.watcher = Watcher(self.root, self.refresh).start()
+                self.sched.add_job(self.scan, 'cron', minute=0, hour=4)
+            else:
+                self.sched.add_job(self.scan, 'cron', minute=0, hour='*')
+            self.sched.add_job(self.warmup, 'date', run_date=datetime.datetime.now() + datetime.timedelta(seconds=30))
+            if self.snapshot:
+                self.sched.add_job(self.save, 'interval', minutes=10)
+            # 其他worker广播的变动由indexer及时重新扫描并写入快照
+            self.sched.add_job(self.sync, 'interval', seconds=1)
+            self.sched.add_job(self.uploads.sweep, 'interval', hours=1)
+            if self.dedup:
+                self.sched.add_job(self.dedup.sweep, 'interval', hours=1)
+            if options.auth:
+                self.sched.add_job(self.count,'interval',seconds=3600)
+        else:
+            # 分片的md5进度在每个进程中各自保存, 都要清理
+            self.sched.add_job(self.uploads.prune, 'interval', hours=1)
         self.sched.start()
 
         if options.auth:
@@ -66,9 +131,16 @@ class Application(Application):
                 self.redis.set(f'{self.prefix}:COUNT_UPDATE',datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
                 self.redis.delete(f'{self.prefix}:UPLOAD_FLAG')
 
+    def run(self, *args, **kwargs):
+        if not options.debug and options.workers > 1:
+            self.bus = Invalidator()
+        super().run(*args, **kwargs)
+
     async def shutdown(self):
         if options.auth:
             await self.redis.save()
+        if self.indexer:
+            self.save()
         await super().shutdown()
         os._exit(0)
 
@@ -102,9 +174,21 @@ class Application(Application):
         load_info_str = f"System Load Average: {load_avg_1:.2f} {load_avg_5:.2f} {load_avg_15:.2f}"
         mem_info = psutil.virtual_memory()
         mem_info_str = (f"Memory Usage: Total: {mem_info.total / (1024 ** 3):.2f} GB Available: {mem_info.available / (1024 ** 3):.2f} GB Used: {mem_info.used / (1024 ** 3):.2f} GB Percent: {mem_info.percent}%")
+        stats = self.cache.stats()
+        cache_info_str = (f"Listing cache: Dirs: {stats['dirs']} Entries: {stats['entries']} "
+                          f"Used: {stats['bytes'] / (1024 ** 2):.1f} / {stats['max_bytes'] / (1024 ** 2):.0f} MB "
+                          f"Hits: {stats['hits']} Misses: {stats['misses']} Evictions: {stats['evictions']} "
+                          f"Hit rate: {stats['hit_rate'] * 100:.1f}% Index build: {self.build_info}")
         self.disk_info_set = set(disk_info_list)
         self.load_info_str = load_info_str
         self.mem_info_str = mem_info_str
+        self.cache_info_str = cache_info_str
+        self.dedup_info_str = None
+        if self.dedup:
+            stats = self.dedup.stats()
+            self.dedup_info_str = (f"Dedup: Objects: {stats['objects']} Links: {stats['links']} "
+                                   f"Saved: {stats['saved'] / (1024 ** 3):.2f} GB Instant: {stats['instant'] / (1024 ** 3):.2f} GB "
+                                   f"Uploads: {stats['uploads']} Hits: {stats['hits']} Hit rate: {stats['hit_rate'] * 100:.1f}%")
 
     def generate_short_link(self,id_str):
         salt = secrets.token_urlsafe(6)
@@ -113,35 +197,215 @@ class Application(Application):
         return md.hexdigest()[:8] + short_code if random.choice([True, False]) else short_code + md.hexdigest()[:8]
 
     def scan_dir(self, root):
-        if not root.exists():
-            return []
-        st_mtime = root.stat().st_mtime
-        if root in self.cache and st_mtime == self.cache[root][0]:
-            entries = self.cache[root][1]
-        else:
-            entries = []
-            for item in root.iterdir():
-                if not item.exists():
-                    continue
-                if item.name.startswith('.'):
-                    continue
-                path = item.relative_to(self.root)
-                entries.append(Dict({
-                    'path': path,
-                    'mtime': int(item.stat().st_mtime),
-                    'size': item.stat().st_size,
-                    'is_dir': item.is_dir(),
-                    'num': int(self.redis.get(f'{self.prefix}:NUM:{str(path)}')) if options.auth and self.redis.exists(f'{self.prefix}:NUM:{str(path)}') else 0
-                }))
-            entries.sort(key=lambda x: str(x.path).lower())
-            self.cache[root] = [st_mtime, entries]
-
+        self.sync()
+        try:
+            st_mtime = os.stat(root).st_mtime
+        except OSError:
+            return Listing(root.relative_to(self.root), 0)
+        entries = self.cache.get(root, st_mtime)
+        if entries is None and self.snapshot and not self.indexer:
+            entries = self.snapshot.get(self.root, root, max(self.stale_before, self.invalidated.get(root, 0)))
+            if entries is not None and entries.mtime != st_mtime:
+                entries = None
+            if entries is not None:
+                # 快照已经包含这次变动, 搜索时可以直接用快照中的记录
+                self.invalidated.pop(root, None)
+                self.cache[root] = entries
+        if entries is None:
+            entries = scan(self.root, root, st_mtime)
+            self.cache[root] = entries
+            if self.content and self.indexer:
+                self.content.submit(root, entries)
         return entries
 
+    def generation(self, scopes):
+        '''搜索结果缓存的版本号, 非indexer还要包含所用快照的mtime
+        '''
+        self.sync()
+        generation = tuple(self.cache.generation(scope) for scope in scopes)
+        if self.snapshot and not self.indexer:
+            generation += (self.snapshot.mtime(),)
+        return generation
+
+    def search(self, query, scope=None):
+        '''按Query搜索, scope限定相对路径及其所在分区, 非indexer还要合并快照中本地未缓存的目录
+        '''
+        self.sync()
+        for root, listing, indices in self.cache.match(query, scope):
+            yield from (listing[i] for i in indices)
+        if self.indexer or not self.snapshot:
+            return
+        # 快照不载入内存, 直接按其中的trigram表查询, 本地缓存只占--cache-mb分到的份额
+        since = self.snapshot.mtime()
+        seen = set()
+        for root, listing, indices in self.snapshot.search(self.root, query, scope):
+            seen.add(root)
+            if root in self.cache:
+                continue
+            if root in self.invalidated or self.stale_before >= since:
+                listing = self.scan_dir(root)
+                indices = query.filter(listing, listing.match(query.needles))
+            yield from (listing[i] for i in indices)
+        # 有变动的目录在快照中可能还是旧的, 新的文件名也就查不到, 直接扫描
+        for root in list(self.invalidated):
+            if root in seen or root in self.cache:
+                continue
+            rel = str(root.relative_to(self.root))
+            if scope and rel != scope and not rel.startswith(scope + '/'):
+                continue
+            listing = self.scan_dir(root)
+            yield from (listing[i] for i in query.filter(listing, listing.match(query.needles)))
+
+    def invalidate(self, root, tree=False):
+        '''目录内容有变动, tree为True时连同已缓存的子目录一起(目录被重命名或移动时), root以外的路径忽略'''
+        root = Path(os.path.abspath(root))
+        if not root.is_relative_to(self.root):
+            return
+        roots = [root]
+        if tree:
+            roots += [key for key, _ in self.cache.items() if root in key.parents]
+        if not self.bus:
+            return self.changed(roots)
+        for root in roots:
+            self.bus.publish(str(root.relative_to(self.root)))
+        self.sync()
+
+    def changed(self, roots):
+        '''非indexer丢弃这些目录的缓存, 之后按快照或重新扫描得到; indexer就地重新扫描并写入快照,
+        索引中始终有这些目录, 已删除的目录连同子目录一起移除
+        '''
+        now = time.time()
+        updated, removed = [], []
+        for root in roots:
+            try:
+                st = os.stat(root)
+            except OSError:
+                st = None
+            if st and not stat.S_ISDIR(st.st_mode):
+                continue
+            if not self.indexer:
+                self.cache.pop(root, None)
+                self.invalidated[root] = now
+            elif st:
+                listing = scan(self.root, root, st.st_mtime)
+                self.cache[root] = listing
+                updated.append((root, listing))
+                if self.content:
+                    self.content.submit(root, listing)
+            if not st:
+                for key in [x for x in self.cache if root in x.parents]:
+                    self.cache.pop(key, None)
+                    removed.append(key)
+                if self.indexer:
+                    self.cache.pop(root, None)
+                    removed.append(root)
+                    if self.content:
+                        self.content.submit(root, None)
+        if self.indexer and self.snapshot and (updated or removed):
+            try:
+                self.snapshot.update(self.root, updated, removed)
+            except Exception as e:
+                self.logger.warning(f'update snapshot failed: {e}')
+
+    def sync(self):
+        if not self.bus:
+            return
+        keys = self.bus.poll()
+        if keys is None or len(self.invalidated) > 100000:
+            self.invalidated.clear()
+            if self.indexer:
+                # indexer的缓存是快照的来源, 不能清空, 按mtime全部核对一遍
+                self.sched.add_job(self.scan)
+                return
+            self.cache.clear()
+            self.stale_before = time.time()
+            return
+        if keys:
+            self.changed([self.root / key for key in keys])
+
+    def load_nums(self, entries, batch=10000):
+        if not options.auth or not entries:
+            return
+        keys = [f'{self.prefix}:NUM:{doc.path}' for doc in entries]
+        p = self.redis.pipeline(transaction=False)
+        for i in range(0, len(keys), batch):
+            p.mget(keys[i:i + batch])
+        nums = [num for ret in p.execute() for num in ret]
+        for doc, num in zip(entries, nums):
+            doc.listing.set_num(doc.index, int(num) if num else 0)
+
+    def refresh(self, dirs):
+        for root in sorted(dirs, key=lambda x: len(x.parts)):
+            if not root.exists() or root == self.root or root.parent in self.cache or root in self.cache:
+                self.invalidate(root)
+
+    def build(self):
+        start = time.time()
+        tops = [self.root / doc.name for doc in self.scan_dir(self.root) if doc.is_dir and not (self.root / doc.name).is_symlink()]
+        workers = options.scan_workers or os.cpu_count()
+        dirs = entries = 0
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(min(workers, len(tops) or 1), mp_context=context) as executor:
+            tasks = [executor.submit(scan_tree, self.root, top) for top in tops]
+            for i, task in enumerate(as_completed(tasks), 1):
+                for root, listing in task.result():
+                    if root not in self.cache:
+                        self.cache[root] = listing
+                    dirs += 1
+                    entries += len(listing)
+                self.build_info = f'{i}/{len(tops)} shards, {dirs} dirs, {entries} entries, {time.time() - start:.1f}s'
+                self.logger.info(f'index build: {self.build_info}')
+
+    def load(self):
+        start = time.time()
+        count = 0
+        try:
+            for root, listing in self.snapshot.load(self.root):
+                if root not in self.cache:
+                    self.cache[root] = listing
+                    count += 1
+            if count:
+                self.build_info = f'loaded {count} dirs from snapshot in {time.time() - start:.1f}s'
+                self.logger.info(f'index {self.build_info}')
+        except Exception as e:
+            count = 0
+            self.logger.warning(f'load snapshot failed: {e}')
+        self.loaded = count > 0
+
+    def save(self):
+        if not self.snapshot:
+            return
+        try:
+            start = time.time()
+            items = self.cache.items()
+            self.snapshot.save(self.root, items)
+            self.logger.info(f'index snapshot saved: {len(items)} dirs in {time.time() - start:.1f}s')
+        except Exception as e:
+            self.logger.warning(f'save snapshot failed: {e}')
+
+    def warmup(self):
+        if self.loader:
+            self.loader.join()
+        if self.loaded:
+            self.scan()
+        else:
+            self.build()
+            self.sweep()
+        self.save()
+
     def scan(self):
         dirs = [self.root] + [f for f in self.root.rglob('*') if f.is_dir()]
         with ThreadPoolExecutor(min(20, len(dirs))) as executor:
             executor.map(self.scan_dir, dirs)
+        self.sweep()
+
+    def sweep(self):
+        '''把缓存中的全部目录交给内容索引核对, 并清理已删除的目录
+        '''
+        if self.content:
+            for root, listing in self.cache.items():
+                self.content.submit(root, listing)
+            self.content.prune()
 
 def main():
     kwargs = dict(
@@ -150,7 +414,7 @@ def main():
     )
     app = Application(**kwargs)
     app.register(bp_disk, bp_user)
-    app.run(port = options.port, max_buffer_size = 1024000 * 1024 * 1024)
+    app.run(port = options.port)
 
 if __name__ == '__main__':
     main()
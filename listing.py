@@ -0,0 +1,795 @@
+# cython: language_level=3
+import bisect
+import collections
+import datetime
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import os
+import re
+import sqlite3
+import stat
+import struct
+import sys
+import threading
+from array import array
+from pathlib import Path
+
+__all__ = ['Listing', 'Entry', 'ListingCache', 'NameIndex', 'Query', 'ResultCache', 'Snapshot', 'Invalidator', 'scan', 'scan_tree']
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class Entry:
+    '''Listing中单个条目的只读视图, 模板和handler按属性访问, 仅在需要展示时创建
+    '''
+    __slots__ = ('listing', 'index')
+
+    key = None
+    link = None
+    expired_at = None
+    shared = None
+    snippet = None
+
+    def __init__(self, listing, index):
+        self.listing = listing
+        self.index = index
+
+    @property
+    def name(self):
+        return self.listing.names[self.index]
+
+    @property
+    def path(self):
+        return Path(self.listing.rel, self.listing.names[self.index])
+
+    @property
+    def mtime(self):
+        return self.listing.mtimes[self.index]
+
+    @property
+    def size(self):
+        return self.listing.sizes[self.index]
+
+    @property
+    def is_dir(self):
+        return bool(self.listing.dirs[self.index])
+
+    @property
+    def num(self):
+        return self.listing.nums[self.index]
+
+    def dict(self):
+        return {'path': self.path, 'mtime': self.mtime, 'size': self.size, 'is_dir': self.is_dir, 'num': self.num}
+
+    def __repr__(self):
+        return f'Entry({self.path})'
+
+
+class Listing:
+    '''单个目录的紧凑列表, 以并行数组保存name/mtime/size/is_dir/num
+    '''
+    __slots__ = ('rel', 'mtime', 'names', 'mtimes', 'sizes', 'dirs', 'nums', 'orders', 'grams')
+
+    BIG = 512
+
+    def __init__(self, rel, mtime):
+        self.rel = str(rel)
+        self.mtime = mtime
+        self.names = []
+        self.mtimes = array('q')
+        self.sizes = array('q')
+        self.dirs = bytearray()
+        self.nums = array('q')
+        self.orders = {}
+        self.grams = None
+
+    def append(self, name, mtime, size, is_dir, num=0):
+        self.names.append(sys.intern(name))
+        self.mtimes.append(int(mtime))
+        self.sizes.append(size)
+        self.dirs.append(1 if is_dir else 0)
+        self.nums.append(num)
+
+    def sort(self):
+        order = sorted(range(len(self.names)), key=lambda i: self.names[i].lower())
+        self.names = [self.names[i] for i in order]
+        self.mtimes = array('q', (self.mtimes[i] for i in order))
+        self.sizes = array('q', (self.sizes[i] for i in order))
+        self.dirs = bytearray(self.dirs[i] for i in order)
+        self.nums = array('q', (self.nums[i] for i in order))
+
+    @property
+    def part(self):
+        '''所属的顶层目录(auth模式下即用户id), 用于搜索分区
+        '''
+        return self.rel.partition('/')[0]
+
+    def column(self, sort):
+        return {'time': self.mtimes, 'size': self.sizes, 'num': self.nums}[sort]
+
+    def order(self, sort='time', reverse=False):
+        '''按sort列排序后的下标数组, 每个Listing每种排序只计算一次
+        '''
+        key = (sort, reverse)
+        order = self.orders.get(key)
+        if order is None:
+            order = array('i', sorted(range(len(self.names)), key=self.column(sort).__getitem__, reverse=reverse))
+            self.orders[key] = order
+        return order
+
+    def set_num(self, index, num):
+        if self.nums[index] != num:
+            self.nums[index] = num
+            self.orders.pop(('num', False), None)
+            self.orders.pop(('num', True), None)
+
+    def cursor(self, index, sort):
+        return f'{self.column(sort)[index]}:{self.names[index]}'
+
+    def seek(self, order, sort, reverse, cursor):
+        '''返回order中排在cursor之后的第一个位置
+        '''
+        value, _, name = cursor.partition(':')
+        try:
+            value = int(value)
+        except ValueError:
+            return 0
+        column = self.column(sort)
+        if reverse:
+            return bisect.bisect_right(order, (-value, name.lower()), key=lambda i: (-column[i], self.names[i].lower()))
+        return bisect.bisect_right(order, (value, name.lower()), key=lambda i: (column[i], self.names[i].lower()))
+
+    def trigrams(self):
+        '''目录内所有文件名(小写)的trigram集合, 大目录同时建立trigram -> 下标的倒排表供match使用
+        '''
+        if len(self.names) < self.BIG:
+            return set().union(*(trigrams(name.lower()) for name in self.names))
+        if self.grams is None:
+            grams = {}
+            for i, name in enumerate(self.names):
+                for gram in trigrams(name.lower()):
+                    posting = grams.get(gram)
+                    if posting is None:
+                        posting = grams[gram] = array('i')
+                    posting.append(i)
+            self.grams = grams
+        return self.grams.keys()
+
+    def match(self, needles):
+        '''返回文件名包含全部needles(已小写)的下标
+        '''
+        grams = set().union(*map(trigrams, needles))
+        if self.grams is not None and grams:
+            postings = sorted((self.grams.get(gram) for gram in grams), key=lambda x: len(x) if x else 0)
+            if not postings[0]:
+                return []
+            indices = set(postings[0])
+            for posting in postings[1:]:
+                indices.intersection_update(posting)
+            candidates = sorted(indices)
+        else:
+            candidates = range(len(self.names))
+        if not needles:
+            return list(candidates)
+        return [i for i in candidates if all(x in self.names[i].lower() for x in needles)]
+
+    def nbytes(self):
+        size = (sys.getsizeof(self.names) + sum(sys.getsizeof(x) for x in self.names) +
+                self.mtimes.itemsize * len(self.names) * 3 + len(self.dirs) + 200)
+        if self.grams:
+            size += sum(len(x) for x in self.grams.values()) * 4 + len(self.grams) * 150
+        return size
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Entry(self, i) for i in range(*index.indices(len(self.names)))]
+        if index < 0:
+            index += len(self.names)
+        return Entry(self, index)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield Entry(self, i)
+
+
+class Query:
+    '''搜索语法, 空格分隔, 关键词之间为AND:
+        ext:pdf,doc             扩展名
+        size:>100MB size:<1k    文件大小, 也可写成范围 size:1M~1G, 单独一个值表示不小于
+        mtime:2025-01~2025-06   修改时间, 可精确到年/月/日, 也支持 mtime:>2025 mtime:<2024-06-01
+    无法解析的条件按普通关键词处理
+    '''
+    UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    SIZE = re.compile(r'^([<>]?)(\d+(?:\.\d+)?)([kmgt]?)b?(?:~(\d+(?:\.\d+)?)([kmgt]?)b?)?$')
+    DATE = re.compile(r'^(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?$')
+
+    def __init__(self, text):
+        self.text = text
+        self.terms = []
+        self.exts = set()
+        self.size = None
+        self.mtime = None
+        for token in text.lower().split():
+            key, _, value = token.partition(':')
+            if key == 'ext' and self.parse_exts(value):
+                self.exts.update(self.parse_exts(value))
+            elif key == 'size' and self.parse_size(value):
+                self.size = self.parse_size(value)
+            elif key == 'mtime' and self.parse_mtime(value):
+                self.mtime = self.parse_mtime(value)
+            else:
+                self.terms.append(token)
+
+    def parse_exts(self, value):
+        '''ext:,或ext:.之类没有扩展名的值返回空集合, 按普通关键词处理'''
+        return {'.' + x for x in (x.lstrip('.') for x in value.split(',')) if x}
+
+    def parse_size(self, value):
+        m = self.SIZE.match(value)
+        if not m:
+            return None
+        op, num, unit, end, end_unit = m.groups()
+        num = int(float(num) * self.UNITS[unit])
+        if end:
+            return (num, int(float(end) * self.UNITS[end_unit]))
+        return {'>': (num + 1, None), '<': (None, num - 1)}.get(op, (num, None))
+
+    def parse_date(self, value):
+        '''返回value所表示时间段的[开始, 结束)时间戳'''
+        m = self.DATE.match(value)
+        if not m:
+            return None
+        year, month, day = m.groups()
+        try:
+            start = datetime.datetime(int(year), int(month or 1), int(day or 1))
+            if day:
+                end = start + datetime.timedelta(days=1)
+            elif month:
+                end = datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+            else:
+                end = datetime.datetime(start.year + 1, 1, 1)
+            return int(start.timestamp()), int(end.timestamp())
+        except (ValueError, OverflowError, OSError):
+            return None
+
+    def parse_mtime(self, value):
+        if value[:1] in ('<', '>'):
+            period = self.parse_date(value[1:])
+            if period:
+                return (period[1], None) if value[0] == '>' else (None, period[0] - 1)
+            return None
+        start, _, end = value.partition('~')
+        start, end = self.parse_date(start), self.parse_date(end or start)
+        if start and end:
+            return start[0], end[1] - 1
+
+    @property
+    def key(self):
+        return ' '.join(sorted(self.text.lower().split()))
+
+    @property
+    def needles(self):
+        '''用于trigram索引的子串, 只有一个扩展名时也作为子串参与筛选'''
+        if len(self.exts) == 1:
+            return self.terms + list(self.exts)
+        return self.terms
+
+    def filter(self, listing, indices):
+        if self.exts:
+            indices = [i for i in indices if not listing.dirs[i] and
+                       os.path.splitext(listing.names[i])[1].lower() in self.exts]
+        if self.size:
+            low, high = self.size
+            sizes = listing.sizes
+            indices = [i for i in indices if not listing.dirs[i] and
+                       (low is None or sizes[i] >= low) and (high is None or sizes[i] <= high)]
+        if self.mtime:
+            low, high = self.mtime
+            mtimes = listing.mtimes
+            indices = [i for i in indices if (low is None or mtimes[i] >= low) and (high is None or mtimes[i] <= high)]
+        return indices
+
+    def score(self, listing, index):
+        '''越小越靠前: 完全匹配 < 前缀匹配 < 词首匹配 < 其他子串, 同级时名字短的、较新的优先'''
+        name = listing.names[index].lower()
+        stem = os.path.splitext(name)[0]
+        rank = 0
+        for term in self.terms:
+            if name == term or stem == term:
+                continue
+            pos = name.find(term)
+            if pos == 0:
+                rank += 1
+            elif not name[pos - 1].isalnum():
+                rank += 2
+            else:
+                rank += 3
+        return rank, len(name), -listing.mtimes[index]
+
+    def top(self, entries, k, limit=0):
+        '''从entries中取评分最高的k条, 最多检查limit条命中后提前结束
+        返回(结果, 命中数, 是否提前结束)
+        '''
+        heap = []
+        total = 0
+        for entry in entries:
+            if limit and total >= limit:
+                return [x[2] for x in sorted(heap, reverse=True)], total, True
+            total += 1
+            score = self.score(entry.listing, entry.index)
+            item = (tuple(-x for x in score), -total, entry)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return [x[2] for x in sorted(heap, reverse=True)], total, False
+
+
+class ResultCache:
+    '''最近的搜索结果, 取出时按版本号校验, 版本不一致视为失效
+    '''
+
+    def __init__(self, size=128):
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] != generation:
+                return None
+            self.data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, generation, value):
+        if not self.size:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (generation, value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+class NameIndex:
+    '''以目录为粒度的文件名trigram倒排索引: trigram -> 目录编号数组
+    删除目录只标记编号失效, 失效编号过半时压缩
+    '''
+
+    def __init__(self):
+        self.postings = {}
+        self.keys = []
+        self.ids = {}
+        self.dead = 0
+
+    def add(self, key, listing):
+        self.remove(key)
+        id = len(self.keys)
+        self.keys.append(key)
+        self.ids[key] = id
+        for gram in listing.trigrams():
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(id)
+
+    def remove(self, key):
+        id = self.ids.pop(key, None)
+        if id is None:
+            return
+        self.keys[id] = None
+        self.dead += 1
+        if self.dead > 1024 and self.dead * 2 > len(self.keys):
+            self.compact()
+
+    def compact(self):
+        mapping = {}
+        keys = []
+        for id, key in enumerate(self.keys):
+            if key is not None:
+                mapping[id] = len(keys)
+                keys.append(key)
+        postings = {}
+        for gram, posting in self.postings.items():
+            posting = array('I', (mapping[id] for id in posting if id in mapping))
+            if posting:
+                postings[gram] = posting
+        self.postings = postings
+        self.keys = keys
+        self.ids = {key: id for id, key in enumerate(keys)}
+        self.dead = 0
+
+    def clear(self):
+        self.postings.clear()
+        self.keys.clear()
+        self.ids.clear()
+        self.dead = 0
+
+    def lookup(self, needles):
+        '''返回可能有文件名包含全部needles(已小写)的目录, needles都不足3个字符时返回全部目录
+        '''
+        grams = set().union(*map(trigrams, needles))
+        if not grams:
+            return [key for key in self.keys if key is not None]
+        postings = sorted((self.postings.get(gram) for gram in grams), key=lambda x: len(x) if x else 0)
+        if not postings[0]:
+            return []
+        ids = set(postings[0])
+        for posting in postings[1:]:
+            ids.intersection_update(posting)
+            if not ids:
+                return []
+        return [self.keys[id] for id in sorted(ids) if self.keys[id] is not None]
+
+
+class ListingCache:
+    '''按目录缓存Listing, 超出条目数或内存预算时按LRU淘汰
+    '''
+
+    def __init__(self, max_bytes=0, max_entries=0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.data = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parts = {}
+        self.version = 0
+        self.versions = {}
+        self.cleared = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, mtime=None):
+        with self.lock:
+            listing = self.data.get(key)
+            if listing is None or (mtime is not None and listing.mtime != mtime):
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return listing
+
+    def __getitem__(self, key):
+        with self.lock:
+            listing = self.data[key]
+            self.data.move_to_end(key)
+            return listing
+
+    def __setitem__(self, key, listing):
+        with self.lock:
+            self.pop(key)
+            self.data[key] = listing
+            self.touch(listing.part)
+            part = self.parts.get(listing.part)
+            if part is None:
+                part = self.parts[listing.part] = NameIndex()
+            part.add(key, listing)
+            self.sizes[key] = listing.nbytes()
+            self.bytes += self.sizes[key]
+            self.entries += len(listing)
+            while len(self.data) > 1 and ((self.max_bytes and self.bytes > self.max_bytes) or
+                                          (self.max_entries and self.entries > self.max_entries)):
+                old, _ = next(iter(self.data.items()))
+                self.pop(old)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            listing = self.data.pop(key, None)
+            if listing is None:
+                return default
+            self.touch(listing.part)
+            part = self.parts.get(listing.part)
+            if part is not None:
+                part.remove(key)
+                if not part.ids:
+                    self.parts.pop(listing.part)
+            self.bytes -= self.sizes.pop(key)
+            self.entries -= len(listing)
+            return listing
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.parts.clear()
+            self.version += 1
+            self.versions.clear()
+            self.cleared = self.version
+            self.sizes.clear()
+            self.bytes = 0
+            self.entries = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def touch(self, part):
+        self.version += 1
+        self.versions[part] = self.version
+
+    def generation(self, scope=None):
+        '''scope所在分区的版本号, 分区内任何目录增删改都会使其增大, scope为None时为全局版本号
+        '''
+        if not scope:
+            return self.version
+        return max(self.versions.get(scope.partition('/')[0], 0), self.cleared)
+
+    def match(self, query, scope=None):
+        '''按Query搜索, 依次返回(目录, Listing, 命中下标)
+        scope为相对路径时只查其所在的顶层分区, 且只返回scope下的目录
+        '''
+        needles = query.needles
+        with self.lock:
+            if scope:
+                part = self.parts.get(scope.partition('/')[0])
+                keys = part.lookup(needles) if part else []
+            else:
+                keys = [key for part in self.parts.values() for key in part.lookup(needles)]
+        for key in keys:
+            listing = self.data.get(key)
+            if listing is None:
+                continue
+            if scope and listing.rel != scope and not listing.rel.startswith(scope + '/'):
+                continue
+            indices = query.filter(listing, listing.match(needles))
+            if indices:
+                yield key, listing, indices
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.data))
+
+    def items(self):
+        with self.lock:
+            return list(self.data.items())
+
+    def copy(self):
+        with self.lock:
+            return dict(self.data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'dirs': len(self.data),
+            'entries': self.entries,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total else 0,
+        }
+
+
+def scan(base, root, st_mtime):
+    entries = Listing(root.relative_to(base), st_mtime)
+    with os.scandir(root) as it:
+        for item in it:
+            if item.name.startswith('.'):
+                continue
+            try:
+                st = item.stat()
+            except OSError:
+                continue
+            entries.append(item.name, st.st_mtime, st.st_size, stat.S_ISDIR(st.st_mode))
+    entries.sort()
+    return entries
+
+
+def scan_tree(base, top):
+    '''在子进程中扫描top下的整棵目录树, 返回[(目录, Listing)]
+    '''
+    result = []
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        try:
+            listing = scan(base, root, os.stat(root).st_mtime)
+        except OSError:
+            continue
+        result.append((root, listing))
+        for i, name in enumerate(listing.names):
+            if listing.dirs[i] and not os.path.islink(root / name):
+                stack.append(root / name)
+    return result
+
+
+class Snapshot:
+    '''将ListingCache持久化到SQLite, 重启后直接加载, 由scan_dir按目录mtime校验
+    多worker时由indexer写入, 其他worker只读并按目录查询, 搜索时按grams表(trigram -> 目录rowid)找出候选目录
+    save定期重写整个快照, 其间目录有变动时由update就地写入, 新增的trigram记在delta表中
+    '''
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def encode(base, root, listing):
+        return (str(root.relative_to(base)), listing.mtime, '\0'.join(listing.names).encode('utf-8', 'surrogateescape'),
+                listing.mtimes.tobytes(), listing.sizes.tobytes(), bytes(listing.dirs))
+
+    def save(self, base, items):
+        '''写入items中的目录, 不在items中(如已被LRU淘汰)但仍然存在的目录沿用旧快照中的记录'''
+        with self.lock:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.filename.with_name(f'{self.filename.name}.{os.getpid()}.tmp')
+            tmp.unlink(missing_ok=True)
+            roots = {root for root, _ in items}
+            kept = ((root, listing) for root, listing in self.load(base) if root not in roots and root.is_dir())
+            conn = sqlite3.connect(tmp)
+            try:
+                conn.execute('CREATE TABLE listing (path TEXT PRIMARY KEY, mtime REAL, names BLOB, mtimes BLOB, sizes BLOB, dirs BLOB)')
+                conn.execute('CREATE TABLE grams (gram TEXT PRIMARY KEY, ids BLOB)')
+                conn.execute('CREATE TABLE delta (gram TEXT, id INTEGER, PRIMARY KEY (gram, id)) WITHOUT ROWID')
+                postings = {}
+                for id, (root, listing) in enumerate(itertools.chain(items, kept), 1):
+                    conn.execute('INSERT OR REPLACE INTO listing (rowid, path, mtime, names, mtimes, sizes, dirs) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (id, *self.encode(base, root, listing)))
+                    for gram in listing.trigrams():
+                        posting = postings.get(gram)
+                        if posting is None:
+                            posting = postings[gram] = array('I')
+                        posting.append(id)
+                conn.executemany('INSERT INTO grams VALUES (?, ?)', ((gram, posting.tobytes()) for gram, posting in postings.items()))
+                conn.commit()
+            finally:
+                conn.close()
+            os.replace(tmp, self.filename)
+
+    def update(self, base, items, removed=()):
+        '''把有变动的目录写入现有快照, removed为已删除的目录; 快照还不存在时等save写入'''
+        with self.lock:
+            if not self.filename.exists():
+                return
+            conn = sqlite3.connect(self.filename, timeout=10)
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS delta (gram TEXT, id INTEGER, PRIMARY KEY (gram, id)) WITHOUT ROWID')
+                for root, listing in items:
+                    row = self.encode(base, root, listing)
+                    conn.execute('INSERT INTO listing (path, mtime, names, mtimes, sizes, dirs) VALUES (?, ?, ?, ?, ?, ?) '
+                                 'ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, names = excluded.names, '
+                                 'mtimes = excluded.mtimes, sizes = excluded.sizes, dirs = excluded.dirs', row)
+                    id, = conn.execute('SELECT rowid FROM listing WHERE path = ?', (row[0],)).fetchone()
+                    conn.executemany('INSERT OR IGNORE INTO delta VALUES (?, ?)', ((gram, id) for gram in listing.trigrams()))
+                conn.executemany('DELETE FROM listing WHERE path = ?', ((str(root.relative_to(base)),) for root in removed))
+                conn.commit()
+            finally:
+                conn.close()
+
+    @staticmethod
+    def decode(row):
+        path, mtime, names, mtimes, sizes, dirs = row
+        listing = Listing(path, mtime)
+        if names:
+            listing.names = [sys.intern(x) for x in names.decode('utf-8', 'surrogateescape').split('\0')]
+        listing.mtimes.frombytes(mtimes)
+        listing.sizes.frombytes(sizes)
+        listing.dirs = bytearray(dirs)
+        listing.nums = array('q', bytes(listing.nums.itemsize * len(listing.names)))
+        return listing
+
+    def load(self, base):
+        if not self.filename.exists():
+            return
+        conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True)
+        try:
+            for row in conn.execute('SELECT * FROM listing'):
+                yield base / row[0], self.decode(row)
+        finally:
+            conn.close()
+
+    def get(self, base, root, since=0):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        if st.st_mtime <= since:
+            return None
+        if getattr(self.local, 'ino', None) != st.st_ino:
+            if getattr(self.local, 'conn', None):
+                self.local.conn.close()
+            self.local.conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True)
+            self.local.conn.execute('PRAGMA mmap_size=268435456')
+            self.local.ino = st.st_ino
+        row = self.local.conn.execute('SELECT * FROM listing WHERE path = ?', (str(root.relative_to(base)),)).fetchone()
+        return self.decode(row) if row else None
+
+    def mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return 0
+
+    def search(self, base, query, scope=None):
+        '''按Query搜索快照, 依次返回(目录, Listing, 命中下标), 只解码grams表选出的候选目录, 不把快照载入内存
+        scope为相对路径时只返回scope下的目录
+        '''
+        try:
+            conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True)
+        except sqlite3.Error:
+            return
+        try:
+            ids = None
+            for gram in set().union(*map(trigrams, query.needles)):
+                posting = array('I')
+                row = conn.execute('SELECT ids FROM grams WHERE gram = ?', (gram,)).fetchone()
+                if row:
+                    posting.frombytes(row[0])
+                found = set(posting)
+                found.update(id for id, in conn.execute('SELECT id FROM delta WHERE gram = ?', (gram,)))
+                ids = found if ids is None else ids & found
+                if not ids:
+                    return
+            if ids is not None:
+                rows = (conn.execute('SELECT * FROM listing WHERE rowid = ?', (id,)).fetchone() for id in sorted(ids))
+            elif scope:
+                rows = conn.execute('SELECT * FROM listing WHERE path = ? OR substr(path, 1, ?) = ?', (scope, len(scope) + 1, scope + '/'))
+            else:
+                rows = conn.execute('SELECT * FROM listing')
+            for row in rows:
+                if not row or (scope and row[0] != scope and not row[0].startswith(scope + '/')):
+                    continue
+                listing = self.decode(row)
+                indices = query.filter(listing, listing.match(query.needles))
+                if indices:
+                    yield base / row[0], listing, indices
+        except sqlite3.Error:
+            return
+        finally:
+            conn.close()
+
+
+class Invalidator:
+    '''fork前创建的共享内存环形队列, 用于在多个worker之间广播失效的目录
+    '''
+    SLOT = 4096
+
+    def __init__(self, slots=1024):
+        self.slots = slots
+        self.buf = mmap.mmap(-1, 8 + slots * self.SLOT)
+        self.lock = multiprocessing.Lock()
+        self.local = threading.Lock()
+        self.seq = 0
+
+    def publish(self, key):
+        data = key.encode('utf-8', 'surrogateescape')[:self.SLOT - 2]
+        with self.lock:
+            seq, = struct.unpack_from('Q', self.buf, 0)
+            offset = 8 + (seq % self.slots) * self.SLOT
+            struct.pack_into('H', self.buf, offset, len(data))
+            self.buf[offset + 2:offset + 2 + len(data)] = data
+            struct.pack_into('Q', self.buf, 0, seq + 1)
+
+    def poll(self):
+        '''返回自上次poll后失效的目录, 队列溢出时返回None表示需要全部失效
+        '''
+        with self.local:
+            seq, = struct.unpack_from('Q', self.buf, 0)
+            if seq == self.seq:
+                return []
+            if seq - self.seq > self.slots:
+                self.seq = seq
+                return None
+            keys = []
+            with self.lock:
+                for i in range(self.seq, seq):
+                    offset = 8 + (i % self.slots) * self.SLOT
+                    length, = struct.unpack_from('H', self.buf, offset)
+                    keys.append(self.buf[offset + 2:offset + 2 + length].decode('utf-8', 'surrogateescape'))
+            self.seq = seq
+            return keys
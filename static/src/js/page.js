@@ -81,9 +81,94 @@ function guid(){
   return (S4()+S4()+"-"+S4()+"-"+S4()+"-"+S4()+"-"+S4()+S4()+S4());
 }
 
+var uploadSession = false;
+function registerUploadSession(){
+  if(uploadSession) return;
+  uploadSession = true;
+  function post(file, data, deferred){
+    data.token = getCookie('token') || '';
+    data.session = file.session;
+    $.post(location.pathname, data, function(ret){
+      if(ret.err == 0){
+        deferred.resolve(ret);
+      }else{
+        deferred.reject(ret);
+      }
+    }).fail(function(){
+      deferred.reject();
+    });
+    return deferred.promise();
+  }
+  // 大文件先创建上传会话, 已收到的分片直接跳过, 全部上传后再合并
+  WebUploader.Uploader.register({
+    'before-send-file': 'createSession',
+    'before-send': 'skipReceived',
+    'after-send-file': 'completeSession'
+  }, {
+    createSession: function(file){
+      var deferred = WebUploader.Deferred(), owner = this.owner;
+      if(file.size <= owner.options.chunkSize) return deferred.resolve();
+      var modified = file.lastModifiedDate ? new Date(file.lastModifiedDate).getTime() : '';
+      var data = {
+        action: 'session',
+        name: file.name,
+        size: file.size,
+        chunk_size: owner.options.chunkSize,
+        resume: [file.name, file.size, modified].join('|'),
+      };
+      function done(ret){
+        if(ret.instant){
+          // 服务端已有相同内容, 秒传
+          file.instant = true;
+          file.parts = [];
+          for(var i = 0; i < file.size / data.chunk_size; i++) file.parts.push(i);
+        }else{
+          file.session = ret.session;
+          file.parts = ret.parts;
+        }
+        deferred.resolve();
+      }
+      post(file, data, WebUploader.Deferred()).then(function(ret){
+        if(!ret.dedup || ret.parts.length || !file.md5) return done(ret);
+        // 服务端开启了去重, 带上md5再问一次
+        file.session = ret.session;
+        file.md5.then(function(md5){
+          data.md5 = md5;
+          post(file, data, WebUploader.Deferred()).then(function(ret){
+            if(!ret.challenge) return done(ret);
+            // 回答服务端随机指定的一段的md5, 证明确实有这个文件
+            var start = ret.challenge[0], end = start + ret.challenge[1];
+            owner.md5File(file, start, end).then(function(proof){
+              post(file, {action: 'instant', proof: proof}, WebUploader.Deferred()).then(done, function(){ done(ret); });
+            }, function(){ done(ret); });
+          }, function(){ done(ret); });
+        }, function(){ done(ret); });
+      }, function(){
+        deferred.reject();
+      });
+      return deferred.promise();
+    },
+    skipReceived: function(block){
+      var deferred = WebUploader.Deferred();
+      if(block.file.parts && block.file.parts.indexOf(block.chunk) >= 0){
+        deferred.reject();
+      }else{
+        deferred.resolve();
+      }
+      return deferred.promise();
+    },
+    completeSession: function(file){
+      var deferred = WebUploader.Deferred();
+      if(!file.session || file.instant) return deferred.resolve();
+      return post(file, {action: 'complete'}, deferred);
+    }
+  });
+}
+
 function webUpload(selector){
   var demoListView = $('#upload-list');
   var succeed = true;
+  registerUploadSession();
   var uploader = WebUploader.create({
     swf: '/static/src/js/Uploader.swf',
     server: location.pathname,
@@ -99,7 +184,7 @@ function webUpload(selector){
     chunked: true,
     chunkSize: 5 * 1024 * 1024,
     chunkRetry: 3,
-    threads: 5,
+    threads: 8,
     formData: {
       token: (function(){ return getCookie('token') || ''; })(),
       guid: (function(){ return guid(); })(),
@@ -127,12 +212,18 @@ function webUpload(selector){
       ,'</tr>'].join(''));
     demoListView.append(html);
 
-    uploader.md5File(file)
+    file.md5 = uploader.md5File(file)
       .progress(function(percent){
         element.progress(file.id, (percent * 100).toFixed(1) + '%');
       });
   });
 
+  uploader.on('uploadBeforeSend', function(block, data){
+    if(block.file.session){
+      data.session = block.file.session;
+    }
+  });
+
   uploader.on('uploadProgress', function(file, percent){
     var tr = demoListView.find('tr#'+ file.id)
       ,tds = tr.children();
@@ -143,31 +234,11 @@ function webUpload(selector){
     console.log('upload succeed' + file.id)
     var tr = demoListView.find('tr#'+ file.id)
       ,tds = tr.children();
-    if(file.size > uploader.options.chunkSize){
-      var data = {
-        action: 'merge',
-        id: file.id,
-        size: file.size,
-        name: file.name,
-      };
-      for(var i in uploader.options.formData){
-        data[i] = uploader.options.formData[i];
-      }
-      $.post(location.pathname, data, function(ret){
-        if(ret.err == 0){
-          tds.eq(2).html('<span style="color: #5FB878;">上传成功</span>');
-        }else{
-          tds.eq(2).html('<span style="color: #FF5722;">上传失败</span>');
-          succeed = false;
-        }
-      })
+    if(file.session || file.instant || ret.err == 0){
+      tds.eq(2).html('<span style="color: #5FB878;">上传成功</span>');
     }else{
-      if(ret.err == 0){
-        tds.eq(2).html('<span style="color: #5FB878;">上传成功</span>');
-      }else{
-        tds.eq(2).html('<span style="color: #FF5722;">上传失败</span>');
-        succeed = false;
-      }
+      tds.eq(2).html('<span style="color: #FF5722;">上传失败</span>');
+      succeed = false;
     }
   });
 
@@ -135,6 +135,9 @@ class Application(Blueprint):
         sockets = tornado.netutil.bind_sockets(port)
         if not self.options.debug and workers > 1:
             tornado.process.fork_processes(workers)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self.ioloop = IOLoop.current()
+            self.loop = self.ioloop.asyncio_loop
 
         signal.signal(signal.SIGTERM, self.sig_handler)
         signal.signal(signal.SIGINT, self.sig_handler)
@@ -0,0 +1,368 @@
+# cython: language_level=3
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from tornado import httputil
+
+__all__ = ['Part', 'MultipartParser', 'ChunkedUpload', 'UploadSession', 'UploadSessions']
+
+BLOCK_SIZE = 1 << 20
+
+
+class Part:
+    '''multipart中的一段, 文件内容写入directory下的临时文件path, 普通字段保存在value中
+    '''
+    __slots__ = ('name', 'filename', 'content_type', 'path', 'fp', 'value', 'max_field')
+
+    def __init__(self, headers, directory, max_field):
+        disposition, params = httputil._parse_header(headers.get('Content-Disposition', ''))
+        if disposition != 'form-data' or not params.get('name'):
+            raise ValueError('invalid multipart/form-data')
+        self.name = params['name']
+        # 浏览器对没有选择文件的file输入框发送空的filename, 与tornado一致按普通字段处理
+        self.filename = params.get('filename') or None
+        self.content_type = headers.get('Content-Type', 'application/unknown')
+        self.path = self.fp = self.value = None
+        self.max_field = max_field
+        if self.filename is None:
+            self.value = bytearray()
+        else:
+            directory.mkdir(parents=True, exist_ok=True)
+            self.path = directory / f'part-{os.urandom(8).hex()}'
+            self.fp = open(self.path, 'xb')
+
+    def write(self, data):
+        if self.fp:
+            self.fp.write(data)
+        elif len(self.value) + len(data) > self.max_field:
+            raise ValueError(f'field {self.name} too large')
+        else:
+            self.value += data
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+class MultipartParser:
+    '''增量解析multipart/form-data, 每个文件边接收边写入临时文件
+    缓冲区只保留一个数据块加一个分隔符的长度, 内存占用与文件大小无关
+    '''
+    PREAMBLE, BOUNDARY, HEADERS, BODY, DONE = range(5)
+
+    def __init__(self, boundary, directory, max_field=1 << 16, max_header=1 << 14):
+        if boundary.startswith(b'"') and boundary.endswith(b'"'):
+            boundary = boundary[1:-1]
+        self.delimiter = b'\r\n--' + boundary
+        self.directory = Path(directory)
+        self.max_field = max_field
+        self.max_header = max_header
+        # 第一个分隔符前没有CRLF, 补上后所有分隔符可以统一查找
+        self.buffer = b'\r\n'
+        self.state = self.PREAMBLE
+        self.part = None
+        self.parts = []
+
+    @property
+    def done(self):
+        return self.state == self.DONE
+
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.state in (self.PREAMBLE, self.BODY):
+                i = self.buffer.find(self.delimiter)
+                if i < 0:
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        if self.part:
+                            self.part.write(self.buffer[:-keep])
+                        self.buffer = self.buffer[-keep:]
+                    return
+                if self.part:
+                    self.part.write(self.buffer[:i])
+                    self.part.close()
+                    self.parts.append(self.part)
+                    self.part = None
+                self.buffer = self.buffer[i + len(self.delimiter):]
+                self.state = self.BOUNDARY
+            elif self.state == self.BOUNDARY:
+                if self.buffer.startswith(b'--'):
+                    self.state = self.DONE
+                    continue
+                # 分隔符所在行的剩余部分(transport padding)直接忽略, 保留行尾CRLF便于匹配空的头部
+                i = self.buffer.find(b'\r\n')
+                if i < 0:
+                    if len(self.buffer) > self.max_header:
+                        raise ValueError('invalid multipart boundary')
+                    return
+                self.buffer = self.buffer[i:]
+                self.state = self.HEADERS
+            elif self.state == self.HEADERS:
+                i = self.buffer.find(b'\r\n\r\n')
+                if i < 0:
+                    if len(self.buffer) > self.max_header:
+                        raise ValueError('multipart headers too large')
+                    return
+                headers = httputil.HTTPHeaders.parse(self.buffer[2:i].decode('utf-8', 'replace'))
+                self.buffer = self.buffer[i + 4:]
+                self.part = Part(headers, self.directory, self.max_field)
+                self.state = self.BODY
+            else:
+                self.buffer = b''
+                return
+
+    def cleanup(self):
+        '''关闭并删除没有被取走的临时文件'''
+        for part in self.parts + [self.part]:
+            if part and part.path:
+                part.close()
+                try:
+                    os.unlink(part.path)
+                except FileNotFoundError:
+                    pass
+
+
+def copy_range(src, dst, offset, length):
+    '''把src的前length字节复制到dst的offset处, 优先用copy_file_range在内核中完成'''
+    position = 0
+    while position < length:
+        try:
+            n = os.copy_file_range(src, dst, length - position, position, offset + position)
+        except OSError:
+            data = os.pread(src, min(BLOCK_SIZE, length - position), position)
+            n = os.pwrite(dst, data, offset + position) if data else 0
+        if n == 0:
+            raise OSError(f'short copy at {position}/{length}')
+        position += n
+
+
+class Progress:
+    '''本进程中一个分片上传的md5进度: 已按顺序计算到第index个分片, 共length字节, used为最后使用的时间'''
+    __slots__ = ('lock', 'md5', 'index', 'length', 'used')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.md5 = hashlib.md5()
+        self.index = self.length = 0
+        self.used = time.time()
+
+
+class ChunkedUpload:
+    '''分片上传: 每个分片直接写入预分配的data文件中的最终位置, 合并只需rename
+    每个分片写完后留下{chunks}_{index}标记(内容为偏移和长度), 多个进程接收同一文件的分片也能合并
+    md5在分片按顺序到齐时增量计算, 合并时只补算本进程没有算过的部分
+    进度保存在每个进程自己的progress中, 放弃的上传由各进程用prune按最后使用时间清理
+    '''
+    progress = {}
+    lock = threading.Lock()
+
+    def __init__(self, directory, size=None):
+        self.directory = Path(directory)
+        self.data = self.directory / 'data'
+        if size is None:
+            size = self.data.stat().st_size if self.data.exists() else 0
+        self.size = size
+
+    def state(self):
+        with self.lock:
+            if self.directory not in self.progress:
+                self.progress[self.directory] = Progress()
+            state = self.progress[self.directory]
+            state.used = time.time()
+            return state
+
+    def forget(self):
+        with self.lock:
+            self.progress.pop(self.directory, None)
+
+    @classmethod
+    def prune(cls, ttl):
+        '''清理本进程中超过ttl秒没有使用或暂存目录已被删除的进度'''
+        expired = time.time() - ttl
+        with cls.lock:
+            for directory, state in list(cls.progress.items()):
+                if state.used < expired or not directory.exists():
+                    del cls.progress[directory]
+
+    def allocate(self):
+        '''创建并预分配data文件, 先在临时文件中分配好再link过去, 避免并发的分片写入未分配完的文件'''
+        if self.data.exists():
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.directory / f'data-{os.urandom(4).hex()}'
+        try:
+            with open(tmp, 'xb') as fp:
+                try:
+                    os.posix_fallocate(fp.fileno(), 0, self.size)
+                except OSError:
+                    fp.truncate(self.size)
+            os.link(tmp, self.data)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def write(self, chunks, index, path, offset=None):
+        '''把第index个分片(临时文件path)写入最终位置, 未给出offset时按除最后一片外各分片长度相同推算'''
+        length = os.path.getsize(path)
+        if offset is None:
+            offset = index * length if index < chunks - 1 else self.size - length
+        if index >= chunks or offset < 0 or offset + length > self.size:
+            raise ValueError(f'chunk {index} out of range')
+        self.allocate()
+        src = os.open(path, os.O_RDONLY)
+        dst = os.open(self.data, os.O_WRONLY)
+        try:
+            copy_range(src, dst, offset, length)
+        finally:
+            os.close(src)
+            os.close(dst)
+        marker = self.directory / f'{chunks}_{index}'
+        if marker.exists():
+            # 重传的分片内容可能不同, 已经算过的md5作废
+            self.forget()
+        marker.write_text(f'{offset} {length}')
+        self.advance(chunks)
+
+    def advance(self, chunks):
+        '''从上次的位置开始, 把已经连续到达的分片依次计入md5'''
+        state = self.state()
+        with state.lock:
+            while state.index < chunks:
+                try:
+                    offset, length = map(int, (self.directory / f'{chunks}_{state.index}').read_text().split())
+                except (FileNotFoundError, ValueError):
+                    break
+                fd = os.open(self.data, os.O_RDONLY)
+                try:
+                    position = offset
+                    while position < offset + length:
+                        data = os.pread(fd, min(BLOCK_SIZE, offset + length - position), position)
+                        if not data:
+                            raise OSError(f'{self.data} truncated')
+                        state.md5.update(data)
+                        position += len(data)
+                finally:
+                    os.close(fd)
+                state.index += 1
+                state.length += length
+            return state
+
+    def received(self, chunks):
+        return sorted(int(x.name.split('_')[1]) for x in self.directory.glob(f'{chunks}_*'))
+
+    def missing(self, chunks):
+        for i in range(chunks):
+            if not (self.directory / f'{chunks}_{i}').exists():
+                return i
+
+    def md5(self, chunks):
+        state = self.advance(chunks)
+        return state.md5.hexdigest() if state.index == chunks and state.length == self.size else None
+
+    def commit(self, filename):
+        shutil.move(self.data, filename)
+        self.abort()
+
+    def abort(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.forget()
+
+
+class UploadSession(ChunkedUpload):
+    '''服务端上传会话, session.json中记录目标路径(相对root)/大小/分片大小/md5
+    分片按固定大小切分, 可以并行乱序上传, 断线后查询已收到的分片继续上传
+    '''
+
+    def __init__(self, directory, meta):
+        super().__init__(directory, meta['size'])
+        self.id = self.directory.name
+        self.meta = meta
+        self.path = meta['path']
+        self.chunk_size = meta['chunk_size']
+        self.chunks = max(-(-self.size // self.chunk_size), 1)
+
+    def write(self, index, path):
+        offset = index * self.chunk_size
+        if not 0 <= index < self.chunks or os.path.getsize(path) != min(self.chunk_size, self.size - offset):
+            raise ValueError(f'chunk {index} size mismatch')
+        super().write(self.chunks, index, path, offset)
+
+    def save(self):
+        tmp = self.directory / f'session-{os.urandom(4).hex()}'
+        tmp.write_text(json.dumps(self.meta))
+        os.replace(tmp, self.directory / 'session.json')
+
+    def parts(self):
+        return self.received(self.chunks)
+
+    def dict(self):
+        return {'session': self.id, 'path': self.path, 'size': self.size, 'chunk_size': self.chunk_size,
+                'chunks': self.chunks, 'parts': self.parts()}
+
+
+class UploadSessions:
+    '''上传会话的存储, 每个会话一个目录, 超过ttl秒没有新分片的会话(包括旧的guid-id分片目录)由sweep删除
+    '''
+
+    def __init__(self, directory, ttl=86400, reserve=64 << 20):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.reserve = reserve
+
+    def available(self, size):
+        '''暂存目录所在的磁盘能否再放下size字节, 并保留reserve字节的余量'''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return shutil.disk_usage(self.directory).free >= size + self.reserve
+
+    def create(self, path, size, chunk_size, md5=None, resume=None):
+        '''创建会话, 给出resume(如文件名/大小/修改时间)时相同的上传得到同一个会话, 用于断点续传'''
+        if resume:
+            id = hashlib.sha1(f'{path}|{size}|{chunk_size}|{resume}'.encode('utf-8', 'surrogateescape')).hexdigest()
+        else:
+            id = os.urandom(20).hex()
+        session = self.get(id)
+        if session:
+            return session
+        directory = self.directory / id
+        directory.mkdir(parents=True, exist_ok=True)
+        meta = {'path': path, 'size': size, 'chunk_size': chunk_size, 'md5': md5, 'created': int(time.time())}
+        session = UploadSession(directory, meta)
+        session.save()
+        return session
+
+    def get(self, id):
+        if not id or not re.fullmatch('[0-9a-f]{40}', id):
+            return None
+        try:
+            meta = json.loads((self.directory / id / 'session.json').read_text())
+        except (OSError, ValueError):
+            return None
+        return UploadSession(self.directory / id, meta)
+
+    def sweep(self):
+        if not self.directory.exists():
+            return
+        expired = time.time() - self.ttl
+        for entry in self.directory.iterdir():
+            try:
+                if entry.stat().st_mtime >= expired:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entry.unlink()
+            except OSError:
+                pass
+        self.prune()
+
+    def prune(self):
+        ChunkedUpload.prune(self.ttl)
@@ -12,6 +12,7 @@ from .decorator import aioretry, retry, smart_decorator, synchronize, timeit
 from .email_utils import AioEmail, Email
 from .http_utils import Response, patch_connection_pool
 from .log_utils import Logger, WatchedFileHandler
+from .watch_utils import InotifyWatcher, PollingWatcher, Watcher
 
 try:
     import pycurl  # noqa
@@ -27,7 +28,7 @@ __all__ = [
     'timeit', 'retry', 'aioretry', 'smart_decorator', 'synchronize', 'cached_property',
     'get_ip', 'connect', 'ip2int', 'int2ip', 'int2str', 'str2int', 'patch_connection_pool', 'parse_uri',
     'Singleton', 'JSONEncoder', 'Dict', 'DefaultDict', 'DictWrapper', 'DictUnwrapper',
-    'Email', 'AioEmail', 'Logger', 'WatchedFileHandler',
+    'Email', 'AioEmail', 'Logger', 'WatchedFileHandler', 'Watcher', 'InotifyWatcher', 'PollingWatcher',
     'Mongo', 'MongoClient', 'Redis', 'AioRedis', 'Motor', 'MotorClient',
     'Request', 'Response'
 ]
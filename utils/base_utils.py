@@ -77,6 +77,8 @@ class JSONEncoder(json.encoder.JSONEncoder):
             return str(obj)
         elif hasattr(obj, 'tolist') and callable(obj.tolist):
             return obj.tolist()
+        elif hasattr(obj, 'dict') and callable(obj.dict):
+            return obj.dict()
         try:
             return super().default(obj)
         except Exception:
@@ -0,0 +1,235 @@
+# cython: language_level=3
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+__all__ = ['Watcher', 'InotifyWatcher', 'PollingWatcher']
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+           IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+
+class BaseWatcher:
+    '''监听root下的目录变化, 合并delay秒内的事件后以变化目录集合回调callback
+    '''
+
+    def __init__(self, root, callback, delay=0.5):
+        self.root = Path(root)
+        self.callback = callback
+        self.delay = delay
+        self.dirty = set()
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def flush(self):
+        if not self.dirty:
+            return
+        dirs, self.dirty = self.dirty, set()
+        try:
+            self.callback(dirs)
+        except Exception as e:
+            self.logger.exception(f'watcher callback error: {e}')
+
+    def walk(self, root):
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            yield path
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path))
+            except OSError:
+                pass
+
+    def run(self):
+        raise NotImplementedError
+
+
+class InotifyWatcher(BaseWatcher):
+
+    def __init__(self, root, callback, delay=0.5):
+        super().__init__(root, callback, delay)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.inotify_rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}
+        self.paths = {}
+        try:
+            for path in self.walk(self.root):
+                self.add_watch(path)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_watch(self, path):
+        wd = self.inotify_add_watch(self.fd, os.fsencode(path), IN_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                raise OSError(code, 'inotify watch limit reached, increase fs.inotify.max_user_watches')
+            return
+        self.wds[wd] = path
+        self.paths[path] = wd
+
+    def rm_watch(self, path):
+        for key in [x for x in self.paths if x == path or path in x.parents]:
+            wd = self.paths.pop(key)
+            self.wds.pop(wd, None)
+            self.inotify_rm_watch(self.fd, wd)
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.logger.warning('inotify queue overflow, rescan all directories')
+            self.dirty.update(self.paths)
+            return
+        path = self.wds.get(wd)
+        if path is None:
+            return
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            if self.paths.get(path) == wd:
+                self.paths.pop(path)
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self.dirty.add(path)
+            return
+        if not name or name.startswith('.'):
+            return
+        self.dirty.add(path)
+        if mask & IN_ISDIR:
+            child = path / name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                for sub in self.walk(child):
+                    try:
+                        self.add_watch(sub)
+                    except OSError as e:
+                        self.logger.warning(f'watch {sub} failed: {e}')
+                    self.dirty.add(sub)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.rm_watch(child)
+                self.dirty.add(child)
+
+    def run(self):
+        deadline = None
+        try:
+            while self.running:
+                timeout = max(0, deadline - time.time()) if deadline else 1
+                readable, _, _ = select.select([self.fd], [], [], timeout)
+                if readable:
+                    try:
+                        data = os.read(self.fd, 65536)
+                    except BlockingIOError:
+                        data = b''
+                    offset = 0
+                    while offset < len(data):
+                        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                        offset += EVENT.size
+                        name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                        offset += length
+                        self.handle(wd, mask, name)
+                    if self.dirty and deadline is None:
+                        deadline = time.time() + self.delay
+                if deadline and time.time() >= deadline:
+                    deadline = None
+                    self.flush()
+        finally:
+            os.close(self.fd)
+
+
+class PollingWatcher(BaseWatcher):
+    '''inotify不可用时的退化方案, 每interval秒检查一次已知目录的mtime
+    '''
+
+    def __init__(self, root, callback, delay=0.5, interval=30):
+        super().__init__(root, callback, delay)
+        self.interval = interval
+        self.mtimes = {}
+        for path in self.walk(self.root):
+            self.mtimes[path] = self.stat(path)
+
+    @staticmethod
+    def stat(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def poll(self):
+        for path, mtime in list(self.mtimes.items()):
+            st_mtime = self.stat(path)
+            if st_mtime == mtime:
+                continue
+            self.dirty.add(path)
+            if st_mtime is None:
+                for key in [x for x in self.mtimes if x == path or path in x.parents]:
+                    self.mtimes.pop(key, None)
+                    self.dirty.add(key)
+                continue
+            self.mtimes[path] = st_mtime
+            try:
+                with os.scandir(path) as it:
+                    children = [Path(x.path) for x in it if not x.name.startswith('.') and x.is_dir(follow_symlinks=False)]
+            except OSError:
+                children = []
+            for child in children:
+                if child not in self.mtimes:
+                    for sub in self.walk(child):
+                        self.mtimes[sub] = self.stat(sub)
+                        self.dirty.add(sub)
+
+    def run(self):
+        while self.running:
+            self.poll()
+            self.flush()
+            for _ in range(int(self.interval / self.delay) or 1):
+                if not self.running:
+                    break
+                time.sleep(self.delay)
+
+
+def Watcher(root, callback, delay=0.5, interval=30):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, callback, delay)
+        except Exception as e:
+            logging.getLogger().warning(f'inotify unavailable ({e}), fallback to polling')
+    return PollingWatcher(root, callback, delay, interval)